@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+from __future__ import division
+
+"""
+A single-pass parser for the SHORT_XML records ADS returns, shared by
+`arxivcite` and `arxivads`.
+"""
+from collections import namedtuple
+
+_ns = '{http://ads.harvard.edu/schema/abs/1.1/references}'
+
+# the record sub-elements we keep, and the `ADSRecord` field they go in
+_fieldtags = {_ns + 'bibcode': 'bibcode',
+              _ns + 'title': 'title',
+              _ns + 'pubdate': 'pubdate',
+              _ns + 'journal': 'journal',
+              _ns + 'citations': 'citations',
+              _ns + 'eprintid': 'eprintid'}
+_recordtag = _ns + 'record'
+_authortag = _ns + 'author'
+_linktag = _ns + 'link'
+
+
+class ADSRecord(namedtuple('ADSRecord', 'bibcode title authors pubdate journal citations eprintid')):
+    """
+    One ADS record.  `authors` is a list, `citations` an int, and the rest
+    are strings.  Anything missing from the record is None (or an empty list
+    for `authors`).
+    """
+    __slots__ = ()
+
+    @property
+    def arxivid(self):
+        """
+        `eprintid` without the 'arXiv:' in front, or None if there's no eprint
+        """
+        if self.eprintid is None:
+            return None
+        return self.eprintid[6:] if self.eprintid.startswith('arXiv:') else self.eprintid
+
+    @property
+    def onlyarxiv(self):
+        """
+        True if the "journal" is just the arXiv
+        """
+        return self.journal is not None and self.journal.startswith('eprint arXiv')
+
+    def data(self):
+        """
+        The dictionary stored in the db for this record, with only the keys
+        for what the record has.
+        """
+        data = {}
+        if self.citations is not None:
+            data['ncites'] = self.citations
+        if self.bibcode is not None:
+            data['bibcode'] = self.bibcode
+        if self.title is not None:
+            data['title'] = self.title
+        if self.authors:
+            data['fauthor'] = self.authors[0]
+            data['allauthors'] = list(self.authors)
+        if self.pubdate is not None:
+            data['pubdate'] = self.pubdate
+        if self.journal is not None:
+            data['journal'] = self.journal
+            data['onlyarxiv'] = self.onlyarxiv
+        return data
+
+
+def iter_records(source):
+    """
+    Yields an `ADSRecord` for each ``record`` in `source`, which is either the
+    XML as a string or a file-like object.  Each record is parsed once, as it
+    is read, and thrown away after it is yielded.
+    """
+    from StringIO import StringIO
+    from xml.etree import cElementTree
+
+    if isinstance(source, basestring):
+        source = StringIO(source.lstrip())
+
+    fields = {}
+    authors = []
+    for event, elem in cElementTree.iterparse(source):
+        tag = elem.tag
+        if tag == _authortag:
+            authors.append(elem.text)
+        elif tag in _fieldtags:
+            # the first one wins, in case of repeats
+            fields.setdefault(_fieldtags[tag], elem.text)
+        elif tag == _linktag:
+            elem.clear()
+        elif tag == _recordtag:
+            citations = fields.get('citations')
+            yield ADSRecord(fields.get('bibcode'), fields.get('title'), authors,
+                            fields.get('pubdate'), fields.get('journal'),
+                            None if citations is None else int(citations),
+                            fields.get('eprintid'))
+            fields = {}
+            authors = []
+            elem.clear()
+
+
+def parse_records(source):
+    """
+    Returns a list of the `ADSRecord` in `source` (see `iter_records`)
+    """
+    return list(iter_records(source))
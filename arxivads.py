@@ -2,61 +2,40 @@
 from __future__ import division
 
 from urllib import urlencode
-from urllib2 import urlopen
-from contextlib import closing
+from httpfetch import fetch
+from adsxml import iter_records
 from xml import sax
 
 
 
 
-class AdsFromArxiv(sax.handler.ContentHandler):
+class AdsFromArxiv(object):
     def __init__(self,adsurl='http://adsabs.harvard.edu'):
         self.inarxivcode = ''
         self.outarxivcode = ''
         self.citations = 0
 
-        self.curr = None
-        self.currname = ''
-
         if adsurl.startswith('http://'):
             self.adsurl = adsurl
         else:
             self.adsurl = 'http://' + adsurl
 
     def reset(self):
-        self.__init__()
-
-    def startElement(self, name, attrs):
-        if name=='eprintid' or name=='citations':
-            self.currname = name
-            self.curr = []
-
-    def endElement(self, name):
-        if self.curr is not None:
-            s = ''.join(self.curr)
-
-            if self.currname == 'eprintid':
-                if s.startswith('arXiv:'):
-                    self.outarxivcode = s[6:]
-            elif self.currname == 'citations':
-                self.citations = int(s)
-
-            self.curr = None
-            self.currname = ''
-
-    def characters(self, chrs):
-        if self.curr is not None:
-            self.curr.append(chrs)
+        self.__init__(self.adsurl)
 
     _ads_query = '%s/cgi-bin/bib_query?arXiv:%s&data_type=SHORT_XML'
     def query_ads(self,arxivcode):
         if '.' not in arxivcode:
             arxivcode = 'astro-ph/'+arxivcode
         url = AdsFromArxiv._ads_query%(self.adsurl,arxivcode)
-        with closing(urlopen(url)) as w:
-            s = w.read()
-
-        sax.parseString(s,self)
+        s = fetch(url)
+
+        rec = next(iter_records(s),None)
+        if rec is not None:
+            if rec.citations is not None:
+                self.citations = rec.citations
+            if rec.eprintid is not None and rec.eprintid.startswith('arXiv:'):
+                self.outarxivcode = rec.arxivid
         self.inarxivcode = arxivcode
         return url
 
@@ -110,23 +89,203 @@ class ArxivSearcher(sax.handler.ContentHandler):
     def characters(self, chrs):
         if self.curr is not None:
             self.curr.append(chrs)
-    _arxivquery='http://export.arxiv.org/api/query?search_query=submittedDate:[{syr}+TO+{eyr}]+AND+cat:astro-ph*&sortBy=submittedDate&sortO%20rder=ascending&start={st}&max_results={mx}'
+    arxivurl = 'http://export.arxiv.org'
+    _arxivquery='{base}/api/query?search_query=submittedDate:[{syr}+TO+{eyr}]+AND+cat:astro-ph*&sortBy=submittedDate&sortO%20rder=ascending&start={st}&max_results={mx}'
     def query_arxiv(self,start=0,mx=10,syr=1992,eyr=2012):
-        url = ArxivSearcher._arxivquery.format(st=start,mx=mx,syr=syr,eyr=eyr)
-        with closing(urlopen(url)) as w:
-            s = w.read()
+        """
+        Gets a page of results into `arxivids`, `pubdates` and `totabs`,
+        replacing whatever was there.  The page is parsed as it arrives (see
+        `iter_arxiv`), so the whole body is never held at once.
+        """
+        entries = list(self.iter_arxiv(start,mx,syr,eyr))
+        self.arxivids = [aid for aid,pub in entries]
+        self.pubdates = [pub for aid,pub in entries]
 
-        sax.parseString(s,self)
+    def iter_arxiv(self,start=0,mx=10,syr=1992,eyr=2012,chunksize=16384):
+        """
+        A streaming `query_arxiv`: the page is fed to the parser as it
+        arrives, and ``(id,published)`` is yielded for each entry as soon as it
+        has been parsed.  `totabs` is set once the parser gets to it, which is
+        before the first entry.  The entries are not kept in `arxivids` and
+        `pubdates`, and anything left there from before is cleared first.
+        """
+        from httpfetch import iter_fetch
 
+        self.reset()
+        url = ArxivSearcher._arxivquery.format(base=self.arxivurl,st=start,mx=mx,syr=syr,eyr=eyr)
+        parser = sax.make_parser()
+        parser.setContentHandler(self)
 
-class Searcher(object):
-    def __init__(self,pfn=None,nperarxiv=1000,pickleperads=50,startyr=1992):
+        for chunk in iter_fetch(url,chunksize=chunksize):
+            parser.feed(chunk)
+            for entry in self._pop_entries():
+                yield entry
+        parser.close()
+        for entry in self._pop_entries():
+            yield entry
+
+    def _pop_entries(self):
+        entries = zip(self.arxivids,self.pubdates)
+        del self.arxivids[:]
+        del self.pubdates[:]
+        return entries
+
+
+class RecordStore(object):
+    """
+    The papers a `Searcher` has found, as typed numpy columns that grow in
+    amortized chunks.  The columns are available as `ids`, `dates` (UTC,
+    datetime64[s] - NaT if there wasn't one), `citations`, `peerrev` and
+    `status`, each a view of the rows in use.
+
+    `status` is one of the class attributes PENDING (not looked up on ADS
+    yet), OK, NOTFOUND (not on ADS) or INVALID (not a valid arxiv ID).  Rows
+    are never deleted, only given a status.
+    """
+    PENDING,OK,NOTFOUND,INVALID = range(4)
+    statusnames = ('pending','ok','not-found','invalid')
+
+    _dtypes = (('ids','S32'),('dates','datetime64[s]'),('citations','i4'),
+               ('peerrev','b1'),('status','i1'))
+
+    def __init__(self,capacity=1024):
+        from numpy import zeros
+
+        self.n = 0
+        self._cols = dict([(nm,zeros(capacity,dtype=dt)) for nm,dt in self._dtypes])
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return '<RecordStore: {0} papers>'.format(self.n)
+
+    def __getstate__(self):
+        # only the rows in use
+        return {'n':self.n,'cols':dict([(nm,self._cols[nm][:self.n]) for nm,dt in self._dtypes])}
+
+    def __setstate__(self,state):
+        self.n = state['n']
+        self._cols = state['cols']
+
+    def _column(nm):
+        return property(lambda self: self._cols[nm][:self.n])
+    ids = _column('ids')
+    dates = _column('dates')
+    citations = _column('citations')
+    peerrev = _column('peerrev')
+    status = _column('status')
+    del _column
+
+    def reserve(self,capacity):
+        """
+        Makes sure there's room for `capacity` rows, at least doubling the
+        size of the columns if they have to grow.
+        """
+        from numpy import zeros
+
+        oldcap = len(self._cols['status'])
+        if capacity <= oldcap:
+            return
+        newcap = max(capacity,2*oldcap)
+        for nm,dt in self._dtypes:
+            col = zeros(newcap,dtype=dt)
+            col[:self.n] = self._cols[nm][:self.n]
+            self._cols[nm] = col
+
+    def extend(self,ids,dates):
+        """
+        Adds PENDING rows for the arxiv `ids`, with `dates` as arxiv date
+        strings (or None).
+        """
+        import datevec
+
+        n0,n1 = self.n,self.n+len(ids)
+        self.reserve(n1)
+        self._cols['ids'][n0:n1] = ids
+        self._cols['dates'][n0:n1] = datevec.parse_arxiv_dates(dates).astype('datetime64[s]')
+        self._cols['status'][n0:n1] = self.PENDING
+        self.n = n1
+
+    def live(self):
+        """
+        Mask of the rows that haven't been dropped (PENDING or OK)
+        """
+        return self.status <= self.OK
+
+    def status_counts(self):
+        """
+        Dictionary of the number of rows with each status name
+        """
+        from numpy import bincount
+
+        counts = bincount(self.status,minlength=len(self.statusnames))
+        return dict(zip(self.statusnames,counts))
+
+
+class YearCursor(object):
+    """
+    How far the search of one year of the arxiv has got, for the concurrent
+    mode of `Searcher.arxiv_search`.  `target` is how many papers the year had
+    when its search started, and `startoffset` how many have been added since
+    (which pushes the later pages along).
+    """
+    def __init__(self,yr):
+        self.yr = yr
         self.ids = []
         self.dates = []
+        self.target = None
+        self.startoffset = 0
+
+    def __repr__(self):
+        return '<YearCursor {0}: {1} of {2}>'.format(self.yr,len(self.ids),self.target)
+
+    @property
+    def done(self):
+        return self.target is not None and len(self.ids) >= self.target
+
+    def next_start(self):
+        """
+        The arxiv query `start` for the next page
+        """
+        return len(self.ids) + self.startoffset
+
+    def add_page(self,ids,dates,totabs):
+        if self.target is None:
+            self.target = totabs
+        self.ids.extend(ids)
+        self.dates.extend(dates)
+        self.startoffset = totabs - self.target
+
+
+class Searcher(object):
+    """
+    Searches the arxiv for astro-ph papers and gets their citation counts from
+    ADS, checkpointing to the pickle file `pfn` as it goes.
+
+    Normally the whole object is re-pickled at every checkpoint.  With
+    `journal`, each arxiv page or ADS result is instead appended to a journal
+    (`journalfn`) as it comes in, and the journal is compacted into the
+    pickle every `compactper` records.  Use `Searcher.load` to pick up from
+    the pickle and journal.
+
+    The papers from finished years are in `records` (a `RecordStore`), and
+    `nqueried` of them have been looked up on ADS so far.  In the concurrent
+    search mode, the years still being searched are in `cursors`.
+    """
+    # so pickles from before the journal existed still load
+    journal = False
+    compactper = 1000
+    journalseq = 0
+    nuncompacted = 0
+    _journalf = None
+
+    def __init__(self,pfn=None,nperarxiv=1000,pickleperads=50,startyr=1992,journal=False,compactper=1000):
+        self.records = RecordStore()
+        self.nqueried = 0
+        self.cursors = {}  # year -> YearCursor
         self.currids = []
         self.currdates = []
-        self.citations = []
-        self.peerrev = []
         self.startarxivtotal = 0
         self.startedyr = None
         self.picklefn = pfn
@@ -135,9 +294,196 @@ class Searcher(object):
         self.pickleperads = pickleperads
         self.yearsdone = []
         self.startyr = startyr
+        self.journal = journal
+        self.compactper = compactper
+        self.journalseq = 0  # seq # of the last journal record applied
+        self.nuncompacted = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_journalf',None)
+        return state
+
+    def __setstate__(self,state):
+        if 'records' not in state:
+            # from before the `RecordStore` - parallel lists, with the papers
+            # that couldn't be found deleted, and `citations` as long as the
+            # number looked up so far
+            records = RecordStore(max(len(state['ids']),1))
+            records.extend(state.pop('ids'),state.pop('dates'))
+            citations = state.pop('citations')
+            nqueried = len(citations)
+            records.citations[:nqueried] = citations
+            records.peerrev[:nqueried] = state.pop('peerrev')
+            records.status[:nqueried] = RecordStore.OK
+            state['records'] = records
+            state['nqueried'] = nqueried
+        state.setdefault('cursors',{})
+        self.__dict__.update(state)
+
+    @property
+    def ids(self):
+        return self.records.ids
+
+    @property
+    def dates(self):
+        return self.records.dates
+
+    @property
+    def citations(self):
+        return self.records.citations
+
+    @property
+    def peerrev(self):
+        return self.records.peerrev
+
+    @property
+    def status(self):
+        return self.records.status
+
+    @classmethod
+    def load(cls,pfn):
+        """
+        Loads the `Searcher` pickled in `pfn`, and replays anything in its
+        journal that came after the pickle was written.
+        """
+        import cPickle
+
+        with open(pfn,'rb') as f:
+            sr = cPickle.load(f)
+        sr.picklefn = pfn
+
+        records,end = read_journal(sr.journalfn)
+        nreplayed = 0
+        for seq,kind,args in records:
+            if seq > sr.journalseq:
+                sr._apply(kind,args)
+                sr.journalseq = seq
+                nreplayed += 1
+        sr.nuncompacted += nreplayed
+        if nreplayed > 0:
+            print 'Replayed',nreplayed,'journal records from',sr.journalfn
+        # drop a torn record from the end, so new ones go after good ones
+        if sr.journal and end is not None:
+            with open(sr.journalfn,'r+b') as f:
+                f.truncate(end)
+        return sr
+
+    @property
+    def journalfn(self):
+        return None if self.picklefn is None else self.picklefn + '.journal'
+
+    def _apply(self,kind,args):
+        """
+        Makes the change to the state described by a journal record
+        """
+        if kind == 'page':
+            ids,dates = args
+            self.currids.extend(ids)
+            self.currdates.extend(dates)
+        elif kind == 'yearstart':
+            self.startedyr,self.startarxivtotal = args
+        elif kind == 'resetyr':
+            self.resetyr(*args)
+        elif kind == 'cursorpage':
+            yr,ids,dates,totabs = args
+            if yr not in self.cursors:
+                self.cursors[yr] = YearCursor(yr)
+            self.cursors[yr].add_page(ids,dates,totabs)
+            self._merge_cursors()
+        elif kind == 'dropcurr':
+            self.currids = []
+            self.currdates = []
+            self.startedyr = None
+            self.startarxivtotal = 0
+        elif kind == 'cite':
+            citations,peerrev = args
+            self.records.citations[self.nqueried] = citations
+            self.records.peerrev[self.nqueried] = peerrev
+            self.records.status[self.nqueried] = RecordStore.OK
+            self.nqueried += 1
+        elif kind in ('status','skip'):
+            #'skip' is from journals written before statuses - the paper was deleted
+            status = args[0] if kind == 'status' else RecordStore.NOTFOUND
+            self.nskipped += 1
+            self.records.status[self.nqueried] = status
+            self.nqueried += 1
+        else:
+            raise ValueError('unknown journal record kind '+str(kind))
 
-    def arxiv_search(self,waittime=3):
-        import time,cPickle,datetime
+    def _log(self,kind,*args):
+        """
+        Applies a change to the state and, in journal mode, appends it to the
+        journal.
+        """
+        import cPickle,os
+
+        journal = self.journal and self.picklefn is not None
+        if journal and self._journalf is None:
+            # the journal is always replayed on top of a pickle, which has to
+            # be from before this record
+            if not os.path.exists(self.picklefn):
+                self.save()
+            self._journalf = open(self.journalfn,'ab')
+
+        self._apply(kind,args)
+        if journal:
+            self.journalseq += 1
+            cPickle.dump((self.journalseq,kind,args),self._journalf,-1)
+            self._journalf.flush()
+            self.nuncompacted += 1
+
+    def save(self):
+        """
+        Pickles the whole object to `picklefn`, replacing it atomically
+        """
+        import cPickle,os
+
+        tmpfn = self.picklefn + '.tmp'
+        with open(tmpfn,'wb') as f:
+            cPickle.dump(self,f,-1)
+        os.rename(tmpfn,self.picklefn)
+
+    def compact(self):
+        """
+        Writes the state to `picklefn` and starts a new, empty journal.
+        """
+        self.save()
+        # a crash before this truncation is fine - the records are all at
+        # or before `journalseq`, so `load` skips them
+        if self._journalf is not None:
+            self._journalf.close()
+        self._journalf = open(self.journalfn,'wb')
+        self.nuncompacted = 0
+
+    def checkpoint(self,final=False):
+        """
+        Saves progress to `picklefn` (if there is one).  In journal mode the
+        records are already on disk, so this only compacts the journal if
+        `compactper` records have built up (or if `final`).
+        """
+        if self.picklefn is None:
+            return
+        if self.journal:
+            if final or self.nuncompacted >= self.compactper:
+                print 'Compacting journal into',self.picklefn
+                self.compact()
+        else:
+            print 'Pickling to',self.picklefn
+            self.save()
+
+    def arxiv_search(self,waittime=3,nconcurrent=1):
+        """
+        Searches the arxiv a year at a time, one query every `waittime` sec.
+
+        With `nconcurrent` > 1, `nconcurrent` years are searched at once (see
+        `concurrent_arxiv_search`).  A search started that way is always
+        carried on that way.
+        """
+        import time,datetime
+
+        if nconcurrent > 1 or self.cursors:
+            return self.concurrent_arxiv_search(waittime,nconcurrent)
 
         nper = self.nperarxiv
 
@@ -153,23 +499,18 @@ class Searcher(object):
             sr = ArxivSearcher()
             sr.query_arxiv(len(self.currids)+self.startarxivtotal,nper,syr=yr,eyr=yr+1)
             if self.startedyr is None:
-                self.startedyr = datetime.datetime.now()
-                self.startarxivtotal = sr.totabs
+                self._log('yearstart',datetime.datetime.now(),sr.totabs)
             target = self.startarxivtotal
             print 'Year',yr,'Has',target,'in total'
 
             while len(self.currids)<target:
                 t0 = time.time()
-                self.currids.extend(sr.arxivids)
-                self.currdates.extend(sr.pubdates)
+                self._log('page',sr.arxivids,sr.pubdates)
                 startoffset = sr.totabs - self.startarxivtotal
 
                 nleft = target - len(self.currids)
                 print 'Have',len(self.currids),'Abstracts',nleft,'Remaining in year',yr,'(Skipped %i)'%startoffset
-                if self.picklefn is not None:
-                    print 'Pickling to',self.picklefn
-                    with open(self.picklefn,'w') as f:
-                        cPickle.dump(self,f,-1)
+                self.checkpoint()
 
                 t1 = time.time()
                 stime = waittime - (t1 - t0)
@@ -180,38 +521,133 @@ class Searcher(object):
                 sr.query_arxiv(len(self.currids)+startoffset,nper,syr=yr,eyr=yr+1)
 
             print 'Search of year',yr,'Complete','(Got %i,Skipped %i)'%(len(self.currids),sr.totabs-self.startarxivtotal)
-            self.resetyr(yr)
-        if self.picklefn is not None:
-            print 'Pickling to',self.picklefn
-            with open(self.picklefn,'w') as f:
-                cPickle.dump(self,f,-1)
-        print 'Completed Search, found',len(self.ids),'Abstracts'
+            self._log('resetyr',yr)
+        self.checkpoint(final=True)
+        print 'Completed Search, found',len(self.records),'Abstracts'
+
 
+    def concurrent_arxiv_search(self,waittime=3,nconcurrent=4):
+        """
+        Searches the arxiv with `nconcurrent` years in progress at once, each a
+        `YearCursor` that pages through its year like `arxiv_search` does.  The
+        queries from all of them together are still one every `waittime` sec.
+
+        A year's papers go into `records` once it and all the years before it
+        are done, so they end up in the same order as `arxiv_search` gives.
+        The cursors are saved with everything else, so an interrupted search
+        picks up where each year left off.
+        """
+        import sys,threading,datetime
+        from httpfetch import RateLimiter
+
+        if self.currids:
+            print 'Dropping',len(self.currids),'papers from the partly-searched year - it will be searched again'
+            self._log('dropcurr')
+
+        yrs = [yr for yr in range(self.startyr,datetime.datetime.now().year+1) if yr not in self.yearsdone]
+        print 'yrs',yrs
+
+        limiter = RateLimiter(waittime)
+        lock = threading.Lock()
+        errors = []
+
+        def harvest():
+            # anything that goes wrong, including in the journal or checkpoint,
+            # is handed back to be re-raised rather than dying with the thread
+            try:
+                while True:
+                    with lock:
+                        if errors or not yrs:
+                            return
+                        yr = yrs.pop(0)
+                        cursor = self.cursors.get(yr)
+                        if yr in self.yearsdone or (cursor is not None and cursor.done):
+                            # finished before this started - it was only waiting
+                            # on an earlier year to be merged
+                            continue
+                        start = 0 if cursor is None else cursor.next_start()
+                        print 'Starting search for year',yr,'at',start
+
+                    while True:
+                        sr = ArxivSearcher()
+                        limiter.wait()
+                        sr.query_arxiv(start,self.nperarxiv,syr=yr,eyr=yr+1)
+
+                        with lock:
+                            if errors:
+                                return
+                            self._log('cursorpage',yr,sr.arxivids,sr.pubdates,sr.totabs)
+                            cursor = self.cursors.get(yr)
+                            if cursor is None or cursor.done:
+                                print 'Search of year',yr,'Complete'
+                                self.checkpoint()
+                                break
+                            print 'Have',len(cursor.ids),'Abstracts',cursor.target-len(cursor.ids),'Remaining in year',yr,'(Skipped %i)'%cursor.startoffset
+                            self.checkpoint()
+                            start = cursor.next_start()
+            except BaseException:
+                with lock:
+                    errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=harvest,name='arxiv_search-'+str(i)) for i in range(nconcurrent)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for t in threads:
+                # with a timeout, so that ctrl-C gets through
+                while t.is_alive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            with lock:
+                errors.append(sys.exc_info())
+            raise
+
+        if errors:
+            # the first error, with its traceback
+            raise errors[0][0],errors[0][1],errors[0][2]
+
+        self.checkpoint(final=True)
+        print 'Completed Search, found',len(self.records),'Abstracts'
+
+    def _merge_cursors(self):
+        """
+        Moves the papers from finished cursors into `records`, in year order
+        """
+        while self.cursors:
+            yr = min(self.cursors)
+            if not self.cursors[yr].done:
+                break
+            if any([y not in self.yearsdone for y in range(self.startyr,yr)]):
+                # an earlier year hasn't even got a cursor yet
+                break
+            cursor = self.cursors.pop(yr)
+            self.records.extend(cursor.ids,cursor.dates)
+            self.yearsdone.append(yr)
 
     def resetyr(self,yr):
         if yr is not None:
             self.yearsdone.append(yr)
-        self.ids.extend(self.currids)
-        self.dates.extend(self.currdates)
+        self.records.extend(self.currids,self.currdates)
         self.currids = []
         self.currdates = []
         self.startedyr = None
         self.startarxivtotal = 0
 
     def get_cite_count(self,waittime=.5,adsurl='http://adsabs.harvard.edu'):
-        import time,cPickle,urllib2
+        import time,urllib2
 
         pickleper = self.pickleperads
         aa = AdsFromArxiv(adsurl=adsurl)
         timeouts = 0
 
-        while len(self.citations)<len(self.ids):
+        while self.nqueried<len(self.records):
             t0 = time.time()
+            arxivid = self.records.ids[self.nqueried]
             try:
-                lasturl = aa.query_ads(self.ids[len(self.citations)])
+                lasturl = aa.query_ads(arxivid)
                 if aa.outarxivcode == '':
-                    self.citations.append(aa.citations)
-                    self.peerrev.append(False)
+                    self._log('cite',aa.citations,False)
                 else:
                     incode = aa.inarxivcode
                     if incode.endswith('v'):
@@ -220,23 +656,21 @@ class Searcher(object):
                         incode = incode[:-2]
 
                     if incode == aa.outarxivcode:
-                        self.citations.append(aa.citations)
-                        self.peerrev.append(True)
+                        self._log('cite',aa.citations,True)
                     else:
                         raise ValueError('arxiv codes do not match: %s , %s from url %s'%(aa.inarxivcode,aa.outarxivcode,lasturl))
             except urllib2.HTTPError,e1:
                 try:
-                    float(self.ids[len(self.citations)])
+                    float(arxivid)
+                    invalid = False
                 except ValueError,e2:
-                    print 'Invalid arxiv id',self.ids[len(self.citations)],'skipping'
-                    self.nskipped += 1
-                    del self.ids[len(self.citations)]
-                    del self.dates[len(self.citations)]
-                if e1.code == 404:
+                    invalid = True
+                if invalid:
+                    print 'Invalid arxiv id',arxivid,'skipping'
+                    self._log('status',RecordStore.INVALID)
+                elif e1.code == 404:
                     print 'URL',e1.geturl(),'not found on ADS, skipping'
-                    self.nskipped += 1
-                    del self.ids[len(self.citations)]
-                    del self.dates[len(self.citations)]
+                    self._log('status',RecordStore.NOTFOUND)
                 elif e1.code == 110:
                     timeouts += 1
                     waitmin = min(3*timeouts,60)
@@ -248,12 +682,10 @@ class Searcher(object):
                     raise
 
             timeouts = 0
-            print 'Got Citations for #',len(self.citations),',',len(self.ids)-len(self.citations),'Remaining'
+            print 'Got Citations for #',self.nqueried,',',len(self.records)-self.nqueried,'Remaining'
 
-            if self.picklefn is not None and len(self.citations)%pickleper==0:
-                print 'Pickling to',self.picklefn
-                with open(self.picklefn,'w') as f:
-                    cPickle.dump(self,f,-1)
+            if self.journal or self.nqueried%pickleper==0:
+                self.checkpoint()
 
 
             aa.reset()
@@ -264,16 +696,31 @@ class Searcher(object):
                 print 'Sleeping',stime,'s'
                 time.sleep(stime)
 
-        if self.picklefn is not None:
-            print 'Final Pickling to',self.picklefn
-            with open(self.picklefn,'w') as f:
-                cPickle.dump(self,f,-1)
+        self.checkpoint(final=True)
 
 
     def cite_array(self):
-        from numpy import array
+        """
+        The citation counts, one for each paper - a view, not a copy.  Only the
+        ones with `status` OK mean anything.
+        """
+        return self.records.citations
+
+    def listing_ordinals(self):
+        """
+        Ordinal of the day (see `datetime.date.toordinal`) on which each paper
+        appears on the listing, and a mask that is False where there's no date
+        or the paper was dropped (those have ordinal -1).
+        """
+        from numpy import isnat
 
-        return array(self.citations)
+        import datevec
+
+        edt = datevec.utc_to_eastern(self.dates)
+        msk = ~isnat(self.dates) & self.records.live()
+        ords = datevec.ordinal(edt) + (datevec.hour(edt) >= 16)
+        ords[~msk] = -1
+        return ords,msk
 
     def wd_array(self,skipweekends=True):
         """
@@ -281,26 +728,14 @@ class Searcher(object):
         Monday is 0 and Sunday is 6
         If `skipweekends` is true, Sat/Sun are pushed to Mon
         """
-        from numpy import array
-        import datetime
-        from pytz import timezone,UTC
-
-        wd = []
-        for d in self.dates:
-            if d is None:
-                wd.append(-1)
-            else:
-                da,ti = d.split('T')
-                dati = []
-                dati.extend(da.split('-'))
-                dati.extend(ti.replace('Z','').split(':'))
-                dati = [int(e) for e in dati]
-                edt = datetime.datetime(*dati,**dict(tzinfo=UTC)).astimezone(timezone('US/Eastern'))
-                if edt.hour<16:
-                    wd.append((edt.weekday()+1)%7)
-                else:
-                    wd.append((edt.weekday()+2)%7)
-        res = array(wd)
+        from numpy import isnat
+
+        import datevec
+
+        edt = datevec.utc_to_eastern(self.dates)
+        #after 4pm it goes on the listing a day later
+        res = (datevec.weekday(edt) + 1 + (datevec.hour(edt) >= 16)) % 7
+        res[isnat(self.dates)] = -1
         if skipweekends:
             res[res>4]=0
         return res
@@ -311,38 +746,11 @@ class Searcher(object):
 
         returns rank,mask,
         """
-        from pytz import timezone,UTC
-        from datetime import datetime,timedelta
-        from numpy import array,zeros,argsort
+        from numpy import zeros,argsort
         from collections import defaultdict
-        from time import strptime
 
         ranks = zeros(len(self.ids))
-        ords = []
-        msk = []
-
-        fmt = '%Y-%m-%dT%H:%M:%SZ'
-        tzeastern = timezone('US/Eastern')
-        dt1 = timedelta(1)
-        for dstr in self.dates:
-            if dstr is not None:
-#                edt = datetime(*(strptime(dstr, fmt)[0:6]),**dict(tzinfo=UTC))
-#                if edt.hour<16:
-#                    date = (edt + dt1).date()
-#                else:
-#                    date = (edt + dt1 + dt1).date()
-                date = datetime(*(strptime(dstr, fmt)[0:6]),**dict(tzinfo=UTC))
-                edate = date.astimezone(tzeastern)
-                if edate.hour<16:
-                    ords.append(edate.toordinal())
-                else:
-                    ords.append(edate.toordinal()+1)
-                msk.append(True)
-            else:
-                ords.append(-1)
-                msk.append(False)
-        ords = array(ords)
-        msk = array(msk)
+        ords,msk = self.listing_ordinals()
 
         dis = defaultdict(list)
         dids = defaultdict(list)
@@ -366,38 +774,11 @@ class Searcher(object):
         return ranks,msk
 
     def papers_over_time(self):
-        from pytz import timezone,UTC
-        from datetime import datetime,timedelta
-        from numpy import array,zeros,argsort
+        from numpy import array,zeros
         from collections import defaultdict
-        from time import strptime
 
         ranks = zeros(len(self.ids))
-        ords = []
-        msk = []
-
-        fmt = '%Y-%m-%dT%H:%M:%SZ'
-        tzeastern = timezone('US/Eastern')
-        dt1 = timedelta(1)
-        for dstr in self.dates:
-            if dstr is not None:
-#                edt = datetime(*(strptime(dstr, fmt)[0:6]),**dict(tzinfo=UTC))
-#                if edt.hour<16:
-#                    date = (edt + dt1).date()
-#                else:
-#                    date = (edt + dt1 + dt1).date()
-                date = datetime(*(strptime(dstr, fmt)[0:6]),**dict(tzinfo=UTC))
-                edate = date.astimezone(tzeastern)
-                if edate.hour<16:
-                    ords.append(edate.toordinal())
-                else:
-                    ords.append(edate.toordinal()+1)
-                msk.append(True)
-            else:
-                ords.append(-1)
-                msk.append(False)
-        ords = array(ords)
-        msk = array(msk)
+        ords,msk = self.listing_ordinals()
 
         dis = defaultdict(list)
         dids = defaultdict(list)
@@ -414,7 +795,7 @@ class Searcher(object):
         for o in dis.keys():
             os.append(o)
             ns.append(len(dids[o]))
-        os,ns = arrary(os),array(ns)
+        os,ns = array(os),array(ns)
 
         return os[os>0],ns[os>0]
 
@@ -422,13 +803,12 @@ class Searcher(object):
         wd = self.wd_array(skipweekends)
         ndays = 5 if skipweekends else 7
         cs = self.cite_array()
-        if wd.size!=cs.size:
-            wd = wd[:cs.size]
+        ok = self.status == RecordStore.OK
 
         if filter0:
-            cspd = [cs[(i==wd)&(0!=cs)] for i in range(ndays)]
+            cspd = [cs[(i==wd)&ok&(0!=cs)] for i in range(ndays)]
         else:
-            cspd = [cs[i==wd] for i in range(ndays)]
+            cspd = [cs[(i==wd)&ok] for i in range(ndays)]
 
         return cspd
 
@@ -460,17 +840,13 @@ class Searcher(object):
         print 'Between ranks'
         rr,mr = self.rank_in_day_array(True)
         cs = self.cite_array()
-
-        if r.size!=cs.size:
-            r = r[:cs.size]
-        if rr.size!=cs.size:
-            rr = rr[:cs.size]
+        ok = self.status == RecordStore.OK
 
         labels = ['1','2','3','4','5','>5','last']
         msks = [r==1,r==2,r==3,r==4,r==5,r>5,rr==-1]
 
         for msk,l in zip(msks,labels):
-            c = cs[msk]
+            c = cs[msk&ok]
             x = (np.arange(c.size)+1)/c.size
             y = c[np.argsort(c)][::-1]
 
@@ -582,6 +958,34 @@ class Searcher(object):
         plt.yticks(np.arange(7),['M','Tu','W','Th','F','Sa','Su'])
         plt.colorbar()
 
+def read_journal(fn):
+    """
+    Reads the ``(seq,kind,args)`` records in the `Searcher` journal `fn`.
+    A record that was only partly written when the writer died (which can
+    only be the last one) is dropped.
+
+    Returns the list of records and the offset of the end of the last good
+    one (None if there's no journal).
+    """
+    import cPickle,os
+
+    if fn is None or not os.path.exists(fn):
+        return [],None
+
+    records = []
+    with open(fn,'rb') as f:
+        end = 0
+        while True:
+            try:
+                records.append(cPickle.load(f))
+            except EOFError:
+                break
+            except Exception,e:
+                print 'Dropping torn journal record at byte',end,'of',fn,':',repr(e)
+                break
+            end = f.tell()
+    return records,end
+
 def funpickle(fileorname,number=0,usecPickle=True):
     """
     Unpickle a pickled object from a specified file and return the contents.
@@ -633,15 +1037,15 @@ def funpickle(fileorname,number=0,usecPickle=True):
     return res
 
 if __name__=='__main__':
-    import os,cPickle,sys
+    import os,sys
 
+    #-j to journal progress instead of re-pickling everything
     if os.path.exists('arxivads.pickle'):
-        with open('arxivads.pickle') as f:
-            sr = cPickle.load(f)
+        sr = Searcher.load('arxivads.pickle')
     else:
-        sr = Searcher(pfn='arxivads.pickle')
+        sr = Searcher(pfn='arxivads.pickle',journal='-j' in sys.argv)
 
-    if len(sys.argv)<2:
+    if len([arg for arg in sys.argv[1:] if arg!='-j'])<1:
         sys.argv.append('-s')
         sys.argv.append('-m')
 
@@ -651,7 +1055,7 @@ if __name__=='__main__':
     if '-m' in sys.argv:
         i = sys.argv.index('-m')
         print 'Starting Match'
-        if len(sys.argv)>(i+1):
+        if len(sys.argv)>(i+1) and not sys.argv[i+1].startswith('-'):
             adsurl = sys.argv[i+1]
             sr.get_cite_count(adsurl=adsurl)
         else:
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+from __future__ import division
+
+"""
+Offline benchmarks for the harvesting pipelines, run against a local
+stand-in for ADS and arXiv so the real mirrors are left alone.
+
+`StandinHandler` serves ADS SHORT_XML records (single ``bib_query`` and
+batch ``nph-abs_connect`` queries), arXiv API Atom pages, and OAI-PMH
+``ListRecords`` pages, each after a configurable latency.  `run_benchmarks`
+times each pipeline against it and appends the results (tagged with the
+git commit) to a JSON-lines file, which `compare_results` compares across
+commits.
+
+Usage::
+
+    python arxivbench.py [pipeline ...]
+    python arxivbench.py compare [basecommit [newcommit]]
+"""
+import os
+import re
+import sys
+import time
+import json
+from urlparse import urlsplit, parse_qs
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+pipelines = ('citecount', 'arxivsearch', 'adsquerier', 'ingest')
+
+_adsns = 'http://ads.harvard.edu/schema/abs/1.1/references'
+_records_header = ('<?xml version="1.0"?>\n<records xmlns="' + _adsns + '" '
+                   'retrieved="{0}" start="1" selected="{0}">\n')
+
+
+def make_ids(n, start=0):
+    """
+    `n` new-style arXiv IDs, 10000 to a month starting at 1001
+    """
+    ids = []
+    for i in range(start, start + n):
+        month = i // 10000
+        ids.append('{0:02d}{1:02d}.{2:04d}'.format(10 + month // 12, 1 + month % 12, i % 10000))
+    return ids
+
+
+def _id_hash(aid):
+    import zlib
+
+    return zlib.crc32(aid) & 0xffffffff
+
+
+_record_template = None
+
+
+def ads_record(aid):
+    """
+    A SHORT_XML ``record`` element for `aid`, made from the record in
+    `arxivcite._yields`
+    """
+    global _record_template
+
+    if _record_template is None:
+        from arxivcite import _yields
+
+        _record_template = _yields[_yields.index('<record>'):_yields.index('</record>') + 9]
+    template = _record_template
+    ncites = _id_hash(aid) % 200
+    return (template.replace('arXiv:1206.2619', 'arXiv:' + aid)
+                    .replace('<citations>3</citations>', '<citations>{0}</citations>'.format(ncites)))
+
+
+def atom_page(yr, start, mx, nperyear):
+    """
+    A page of arXiv API results for the submissions in year `yr`, which has
+    `nperyear` of them
+    """
+    entries = []
+    for i in range(start, min(start + mx, nperyear)):
+        aid = '{0:02d}{1:02d}.{2:04d}'.format(yr % 100, 1 + i % 12, i // 12)
+        published = '{0}-{1:02d}-{2:02d}T{3:02d}:{4:02d}:00Z'.format(yr, 1 + i % 12, 1 + i % 28, i % 24, i % 60)
+        entries.append('<entry><id>http://arxiv.org/abs/{0}v1</id><published>{1}</published>'
+                       '<title>Paper {0}</title></entry>'.format(aid, published))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+            '<opensearch:totalResults>{0}</opensearch:totalResults>{1}</feed>').format(nperyear, ''.join(entries))
+
+
+def oai_record(aid):
+    return ('<record><header><identifier>oai:arXiv.org:{0}</identifier></header><metadata>'
+            '<arXivRaw xmlns="http://arxiv.org/OAI/arXivRaw/"><id>{0}</id>'
+            '<version version="v1"><date>Mon, 2 Apr 2007 19:18:42 GMT</date><size>10kb</size></version>'
+            '</arXivRaw></metadata></record>').format(aid)
+
+
+def oai_page(start, n, ntotal):
+    """
+    An OAI-PMH ``ListRecords`` page of `n` records starting at `start`, out of
+    `ntotal`.  The resumption token is the start of the next page.
+    """
+    ids = make_ids(max(min(n, ntotal - start), 0), start)
+    token = str(start + n) if start + n < ntotal else ''
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><responseDate>2013-01-01T00:00:00Z</responseDate>'
+            '<ListRecords>{0}<resumptionToken>{1}</resumptionToken></ListRecords></OAI-PMH>').format(''.join([oai_record(aid) for aid in ids]), token)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Answers like ADS, the arXiv API, or the arXiv OAI-PMH interface depending
+    on the path.  The settings are on the server (see `StandinServer`).
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real mirrors
+    disable_nagle_algorithm = True  # or small responses wait on delayed ACKs
+
+    def do_GET(self):
+        srv = self.server
+        if srv.latency > 0:
+            time.sleep(srv.latency)
+
+        scheme, host, path, query, fragment = urlsplit(self.path)
+        if path == '/cgi-bin/bib_query':
+            aid = query.split('&')[0]
+            if aid.startswith('arXiv:'):
+                aid = aid[6:]
+            if srv.not_found(aid):
+                return self.send_body('not found', 404)
+            self.send_body(_records_header.format(1) + ads_record(aid) + '\n</records>\n')
+
+        elif path == '/cgi-bin/nph-abs_connect':
+            bibcodes = parse_qs(query).get('bibcode', [''])[0].split('\r\n')
+            aids = [b[6:] if b.startswith('arXiv:') else b for b in bibcodes]
+            recs = [ads_record(aid) for aid in aids if aid and not srv.not_found(aid)]
+            self.send_body(_records_header.format(len(recs)) + '\n'.join(recs) + '\n</records>\n')
+
+        elif path == '/api/query':
+            qs = parse_qs(query)
+            yr = int(re.search(r'submittedDate:\[(\d{4})', query).group(1))
+            self.send_body(atom_page(yr, int(qs['start'][0]), int(qs['max_results'][0]), srv.nperyear))
+
+        elif path == '/oai2':
+            token = parse_qs(query).get('resumptionToken', ['0'])[0]
+            self.send_body(oai_page(int(token), srv.oaipagesize, srv.noai))
+
+        else:
+            self.send_body('no such page', 404)
+
+    def send_body(self, body, code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    """
+    The stand-in server.  Each request waits `latency` sec before being
+    answered.  A `notfoundfrac` fraction of the IDs (always the same ones) are
+    not found by ADS.  The arXiv API has `nperyear` submissions in every year,
+    and OAI has `noai` records in pages of `oaipagesize`.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0, notfoundfrac=0, nperyear=1000,
+                 noai=10000, oaipagesize=1000):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandinHandler)
+        self.latency = latency
+        self.notfoundfrac = notfoundfrac
+        self.nperyear = nperyear
+        self.noai = noai
+        self.oaipagesize = oaipagesize
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def not_found(self, aid):
+        return (_id_hash(aid) % 10000) < self.notfoundfrac * 10000
+
+
+def _serve(pipe, kwargs):
+    srv = StandinServer(**kwargs)
+    pipe.send(srv.url)
+    srv.serve_forever()
+
+
+def start_standin(**kwargs):
+    """
+    Starts a `StandinServer` (with the given keywords) in a separate process,
+    so that its CPU time does not count against the benchmarks.  Returns the
+    process and the server's URL.
+    """
+    from multiprocessing import Process, Pipe
+
+    parentpipe, childpipe = Pipe()
+    proc = Process(target=_serve, args=(childpipe, kwargs))
+    proc.daemon = True
+    proc.start()
+    return proc, parentpipe.recv()
+
+
+class quiet(object):
+    """
+    A context manager that sends stdout to /dev/null, so the pipelines'
+    progress messages don't get timed
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def measure(func, nids):
+    """
+    Runs `func` and returns the wall and CPU time, peak memory use and IDs/sec
+    given that it processes `nids` IDs.  The CPU and memory of any child
+    processes it waits for are counted separately.
+
+    The peak memory is ``ru_maxrss``, which is the peak over the life of the
+    process, so it is only `func`'s own if `func` is the only thing the
+    process runs - `run_isolated` makes sure of that.
+    """
+    import resource
+
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    child0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    t0 = time.time()
+    with quiet():
+        func()
+    elapsed = time.time() - t0
+    self1 = resource.getrusage(resource.RUSAGE_SELF)
+    child1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {'nids': nids,
+            'elapsed': elapsed,
+            'idspersec': nids / elapsed if elapsed > 0 else float('nan'),
+            'cpuself': (self1.ru_utime - self0.ru_utime) + (self1.ru_stime - self0.ru_stime),
+            'cpuchildren': (child1.ru_utime - child0.ru_utime) + (child1.ru_stime - child0.ru_stime),
+            'maxrss_kb': self1.ru_maxrss,
+            'maxrss_children_kb': child1.ru_maxrss}
+
+
+def bench_citecount(url, n=1000):
+    """
+    `arxivads.Searcher.get_cite_count` for `n` IDs
+    """
+    from arxivads import Searcher
+
+    sr = Searcher()
+    sr.records.extend(make_ids(n), [None] * n)
+    return measure(lambda: sr.get_cite_count(waittime=0, adsurl=url), n)
+
+
+def bench_arxivsearch(url, nyears=2, nperarxiv=500, nconcurrent=1):
+    """
+    `arxivads.Searcher.arxiv_search` over the last `nyears` years, getting
+    `nperarxiv` results per page, with `nconcurrent` years at once
+    """
+    import datetime
+    from arxivads import ArxivSearcher, Searcher
+
+    def search():
+        oldurl = ArxivSearcher.arxivurl
+        ArxivSearcher.arxivurl = url
+        try:
+            sr.arxiv_search(waittime=0, nconcurrent=nconcurrent)
+        finally:
+            ArxivSearcher.arxivurl = oldurl
+
+    sr = Searcher(nperarxiv=nperarxiv, startyr=datetime.datetime.now().year - nyears + 1)
+    res = measure(search, 0)
+    res['nids'] = len(sr.ids)
+    res['idspersec'] = len(sr.ids) / res['elapsed']
+    return res
+
+
+def bench_adsquerier(url, n=1000, nmirrors=4, dbname='citestats_bench', **querierkwargs):
+    """
+    `arxivcite.ADSQuerier.main_loop` for `n` IDs spread over `nmirrors`
+    copies of the stand-in, using a scratch collection in `dbname`.  Other
+    keywords go to `ADSQuerier`.
+    """
+    from pymongo import MongoClient
+    from arxivcite import ADSQuerier
+
+    conn = MongoClient()
+    try:
+        coll = conn[dbname]['bench']
+        coll.drop()
+        coll.insert([{'arxiv_id': aid} for aid in make_ids(n)])
+
+        querierkwargs.setdefault('querywaittime', 0)
+        querierkwargs.setdefault('statuslinewaittime', 1e9)
+        querierkwargs.setdefault('probeinterval', None)
+        mirrorurls = [('standin{0}'.format(i), url) for i in range(nmirrors)]
+        q = ADSQuerier(dbname, 'bench', mirrorurls=mirrorurls, **querierkwargs)
+        return measure(q.main_loop, n)
+    finally:
+        conn.drop_database(dbname)
+        conn.close()
+
+
+def fetch_reclists(url, outprefix):
+    """
+    Saves all the stand-in's OAI ``ListRecords`` pages to files starting with
+    `outprefix`, like the OAI harvester does.  Returns the file names.
+    """
+    from httpfetch import fetch
+
+    fns = []
+    token = '0'
+    while token:
+        body = fetch(url + '/oai2?verb=ListRecords&resumptionToken=' + token, usecache=False)
+        fns.append('{0}{1:04d}'.format(outprefix, len(fns)))
+        with open(fns[-1], 'w') as f:
+            f.write(body)
+        token = re.search(r'<resumptionToken>(\d*)</resumptionToken>', body).group(1)
+    return fns
+
+
+def bench_ingest(url, nprocs=1, dbname='citestats_bench'):
+    """
+    `arxivcite.populate_mongodb_from_arxiv_reclists` on the stand-in's OAI
+    reclists, using a scratch collection in `dbname`
+    """
+    import shutil
+    import tempfile
+    from pymongo import MongoClient
+    from arxivcite import populate_mongodb_from_arxiv_reclists
+
+    tmpdir = tempfile.mkdtemp()
+    conn = MongoClient()
+    try:
+        fns = fetch_reclists(url, os.path.join(tmpdir, 'reclist'))
+        summary = {}
+
+        def ingest():
+            summary.update(populate_mongodb_from_arxiv_reclists(fns, dbname, 'bench', verbose=False, nprocs=nprocs))
+
+        conn.drop_database(dbname)
+        res = measure(ingest, 0)
+        res['nids'] = summary['nrecords']
+        res['idspersec'] = summary['nrecords'] / res['elapsed']
+        return res
+    finally:
+        conn.drop_database(dbname)
+        conn.close()
+        shutil.rmtree(tmpdir)
+
+
+def git_commit():
+    """
+    Returns ``(commit hash, dirty)`` for the tree this module is in
+    """
+    import subprocess
+
+    repodir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repodir).strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '-uno'], cwd=repodir)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, len(status.strip()) > 0
+
+
+def _bench_proc(name, url, kwargs, pipe):
+    import traceback
+
+    try:
+        pipe.send((True, globals()['bench_' + name](url, **kwargs)))
+    except BaseException:
+        pipe.send((False, traceback.format_exc()))
+    finally:
+        pipe.close()
+
+
+def run_isolated(name, url, kwargs):
+    """
+    Runs the ``bench_<name>`` benchmark (with `kwargs`) in a fresh process and
+    returns its results, so the peak memory is for that benchmark alone, and
+    not whatever ran before it.
+    """
+    from multiprocessing import Process, Pipe
+
+    parentpipe, childpipe = Pipe(False)
+    proc = Process(target=_bench_proc, args=(name, url, kwargs, childpipe))
+    proc.start()
+    childpipe.close()
+    try:
+        ok, res = parentpipe.recv()
+    except EOFError:
+        ok, res = False, 'the benchmark process died with exit code {0}'.format(proc.exitcode)
+    finally:
+        proc.join()
+    if not ok:
+        raise RuntimeError('{0} benchmark failed:\n{1}'.format(name, res))
+    return res
+
+
+def run_benchmarks(which=pipelines, resultsfn='bench_results.jsonl', latency=0.01,
+                   notfoundfrac=0.01, pipelinekwargs=None):
+    """
+    Runs the benchmarks in `which` (from `pipelines`) against a stand-in with
+    the given `latency` and `notfoundfrac`, and appends the results to
+    `resultsfn` (if not None).
+
+    `pipelinekwargs` maps pipeline names to dicts of keywords for their
+    ``bench_*`` function.  Each runs in its own process (see `run_isolated`).
+    Returns the list of results.
+    """
+    import platform
+    import datetime
+
+    pipelinekwargs = {} if pipelinekwargs is None else pipelinekwargs
+    proc, url = start_standin(latency=latency, notfoundfrac=notfoundfrac)
+    commit, dirty = git_commit()
+    results = []
+    try:
+        for name in which:
+            if name not in pipelines:
+                raise ValueError('unknown pipeline ' + str(name))
+            kwargs = pipelinekwargs.get(name, {})
+            print 'Running', name, 'benchmark', kwargs
+            res = run_isolated(name, url, kwargs)
+            res.update({'pipeline': name,
+                        'params': dict(kwargs, latency=latency, notfoundfrac=notfoundfrac),
+                        'commit': commit,
+                        'dirty': dirty,
+                        'time': datetime.datetime.now().isoformat(),
+                        'python': platform.python_version()})
+            print '{0}: {1:.1f} IDs/sec, {2:.2f} sec CPU (+{3:.2f} children), {4} kB max RSS'.format(
+                name, res['idspersec'], res['cpuself'], res['cpuchildren'], res['maxrss_kb'])
+            results.append(res)
+            if resultsfn is not None:
+                with open(resultsfn, 'a') as f:
+                    f.write(json.dumps(res) + '\n')
+    finally:
+        proc.terminate()
+        proc.join()
+    return results
+
+
+def load_results(resultsfn='bench_results.jsonl'):
+    with open(resultsfn) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(resultsfn='bench_results.jsonl', base=None, new=None):
+    """
+    Compares the benchmarks for commit `base` to those for `new` (prefixes of
+    the hashes are fine).  These default to the last two commits in
+    `resultsfn`.  Runs with the same pipeline and parameters are compared,
+    using the mean if there is more than one.
+
+    Prints a table, and returns it as a list of ``(pipeline, params, base
+    IDs/sec, new IDs/sec, ratio)``.
+    """
+    from numpy import mean
+
+    results = load_results(resultsfn)
+    commits = []
+    for res in results:
+        if res['commit'] not in commits:
+            commits.append(res['commit'])
+        else:  # keep them in order of the last run
+            commits.remove(res['commit'])
+            commits.append(res['commit'])
+
+    def find_commit(prefix, default):
+        if prefix is None:
+            return default
+        matches = [c for c in commits if c is not None and c.startswith(prefix)]
+        if len(matches) != 1:
+            raise ValueError('{0} commits in {1} match {2}'.format(len(matches), resultsfn, prefix))
+        return matches[0]
+
+    if len(commits) < 2 and (base is None or new is None):
+        raise ValueError('need results from two commits to compare')
+    base = find_commit(base, commits[-2])
+    new = find_commit(new, commits[-1])
+
+    def rates(commit):
+        byrun = {}
+        for res in results:
+            if res['commit'] == commit:
+                key = (res['pipeline'], json.dumps(res['params'], sort_keys=True))
+                byrun.setdefault(key, []).append(res['idspersec'])
+        return dict([(key, mean(vals)) for key, vals in byrun.iteritems()])
+
+    baserates = rates(base)
+    newrates = rates(new)
+
+    print 'Comparing', base[:10], '->', new[:10]
+    rows = []
+    for key in sorted(set(baserates) & set(newrates)):
+        ratio = newrates[key] / baserates[key]
+        rows.append((key[0], key[1], baserates[key], newrates[key], ratio))
+        print '{0:12s} {1:10.1f} -> {2:10.1f} IDs/sec ({3:+.1%})  {4}'.format(key[0], baserates[key], newrates[key], ratio - 1, key[1])
+    return rows
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == 'compare':
+        compare_results('bench_results.jsonl', *args[1:3])
+    else:
+        run_benchmarks(args if args else pipelines)
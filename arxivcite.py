@@ -10,6 +10,8 @@ import Queue as queue
 import numpy as np
 from pyoai2 import pyoai2
 
+from httpfetch import RateLimiter
+
 mirrors = [
  ('Harvard-Smithsonian Center for Astrophysics, Cambridge, USA', 'http://adsabs.harvard.edu'),
  ('Centre de Donnes astronomiques de Strasbourg, France', 'http://cdsads.u-strasbg.fr'),
@@ -61,7 +63,7 @@ def query_ads_for_citations_from_arxiv_ids(ids, adsurl='http://adsabs.harvard.ed
         The citation count for the articles in `ids`
     """
     from urllib import urlencode
-    from urllib2 import urlopen
+    from httpfetch import fetch
 
     if len(ids) <= nperquery:
         bibcodes = 'arXiv:' + '\r\narXiv:'.join(ids)
@@ -76,11 +78,7 @@ def query_ads_for_citations_from_arxiv_ids(ids, adsurl='http://adsabs.harvard.ed
 
         url = adsurl + '/cgi-bin/nph-abs_connect?' + urlencode(params)
 
-        u = urlopen(url)
-        try:
-            res = u.read()
-        finally:
-            u.close()
+        res = fetch(url)
 
         citecountd = {}
 
@@ -103,21 +101,48 @@ def query_ads_for_citations_from_arxiv_ids(ids, adsurl='http://adsabs.harvard.ed
     return citecounts
 
 
-def get_arxiv_ids(recprefix='arXiv_oai/reclist', sessionnum=''):
+def get_arxiv_ids(recprefix='arXiv_oai/reclist', sessionnum='', nprocs=1):
     """
     Returns a list of the arxiv IDS from the OAI2 session
+
+    If `nprocs` is >1, the files are parsed in a pool of that many processes.
     """
     from glob import glob
-    from xml.etree import ElementTree
+    from multiprocessing import Pool
 
     fns = glob(recprefix + str(sessionnum) + '*')
 
+    if nprocs > 1:
+        pool = Pool(nprocs)
+        try:
+            idlists = pool.map(reclist_ids, fns, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        idlists = []
+        for fn in fns:
+            print 'Processing', fn
+            idlists.append(reclist_ids(fn))
+
     ids = []
-    for fn in fns:
-        print 'Processing', fn
-        et = ElementTree.parse(fn)
-        ids.extend([e.text for e in et.findall('.//{http://arxiv.org/OAI/arXivRaw/}id')])
+    for idlist in idlists:
+        ids.extend(idlist)
+    return ids
+
+
+def reclist_ids(fn):
+    """
+    Returns the arxiv ids in the reclist file `fn`, parsing it incrementally.
+    """
+    from xml.etree import cElementTree
 
+    ids = []
+    for event, elem in cElementTree.iterparse(fn):
+        if elem.tag == '{http://arxiv.org/OAI/arXivRaw/}id':
+            ids.append(elem.text)
+        elif elem.tag == '{http://www.openarchives.org/OAI/2.0/}record':
+            elem.clear()
     return ids
 
 
@@ -182,207 +207,774 @@ def kill_mongodbs():
         os.kill(pid, signal.SIGTERM)
 
 
+def ensure_indexes(coll):
+    """
+    Makes sure the indexes this module relies on exist on `coll`:
+
+    * A unique index on ``arxiv_id``, used by every per-paper update.
+    * An index on ``bibcode``, so the papers still missing one (which index as
+      null) can be found without a collection scan.
+    * A sparse index on ``ncites``, which only holds the papers that have
+      been matched to ADS.
+    * A sparse index on ``ncites_updated`` (see `ads_data_update`), so the
+      latest update can be found without a collection scan.
+
+    If there are already duplicate ``arxiv_id`` values, a non-unique index is
+    made instead (with a warning).
+
+    `populate_mongodb_from_arxiv_reclists` calls this when it fills the db.
+    A db that was filled some other way only needs it run once.
+    """
+    from pymongo.errors import DuplicateKeyError, OperationFailure
+
+    try:
+        coll.create_index('arxiv_id', unique=True)
+    except (DuplicateKeyError, OperationFailure) as e:
+        print 'Could not create unique index on arxiv_id, using non-unique instead. Error:', e
+        coll.create_index('arxiv_id', name='arxiv_id_nonunique')
+    coll.create_index('bibcode')
+    coll.create_index('ncites', sparse=True)
+    coll.create_index('ncites_updated', sparse=True)
+
+
+def ads_data_update(data):
+    """
+    The db update that stores the ADS `data` for a paper.  It also sets
+    ``ncites_updated`` to the current (UTC) time, so `citesnapshot` can tell
+    from the latest one whether anything has changed.
+    """
+    import datetime
+
+    return {'$set': dict(data, ncites_updated=datetime.datetime.utcnow())}
+
+
+monthstrtonum = {'Jan': 1,
+                 'Feb': 2,
+                 'Mar': 3,
+                 'Apr': 4,
+                 'May': 5,
+                 'Jun': 6,
+                 'Jul': 7,
+                 'Aug': 8,
+                 'Sep': 9,
+                 'Oct': 10,
+                 'Nov': 11,
+                 'Dec': 12}
+
+
 def populate_mongodb_from_arxiv_reclists(reclistfns, dbname='citestats',
-    collname='astroph', verbose=True):
-    from datetime import datetime
-    from xml.etree import cElementTree
+    collname='astroph', verbose=True, batchsize=1000, nprocs=1, resume=False):
+    """
+    Fills the db from OAI reclist files.  The files are parsed incrementally
+    and inserted `batchsize` documents at a time, so memory use does not grow
+    with the size of the files.  If `nprocs` is >1, the files are spread over
+    a pool of that many processes, each writing its own documents.
+
+    The indexes are made first (see `ensure_indexes`).  Documents are
+    inserted if the collection starts out empty, and otherwise upserted on
+    ``arxiv_id``, so papers already there are not reported as failed inserts
+    and their ADS data is left alone.
+
+    If `resume` is True, documents are always upserted, and each ingested
+    file is recorded in the ``<collname>_manifest`` collection.  Files already
+    in the manifest as ``complete`` (no records failed) with the same size and
+    mtime are skipped (see `ingest_reclist_file`).
+
+    Returns a dictionary with the total ``nrecords`` inserted, ``nfailed``
+    records, ``nskipped`` files, the ``elapsed`` time, and ``files``: a list of
+    the `ingest_reclist_file` summaries for each file.
+    """
+    import time
     from glob import glob
+    from multiprocessing import Pool
     from pymongo import MongoClient
 
-    monthstrtonum = {'Jan': 1,
-                     'Feb': 2,
-                     'Mar': 3,
-                     'Apr': 4,
-                     'May': 5,
-                     'Jun': 6,
-                     'Jul': 7,
-                     'Aug': 8,
-                     'Sep': 9,
-                     'Oct': 10,
-                     'Nov': 11,
-                     'Dec': 12}
-
     if isinstance(reclistfns, basestring):
         reclistfns = glob(reclistfns)
 
+    sttime = time.time()
     conn = MongoClient()
     try:
         coll = conn[dbname][collname]
+        ensure_indexes(coll)
+        upsert = resume or coll.count() > 0
 
-        for fn in reclistfns:
-            if verbose:
-                print 'Populating db for file', fn
-
-            et = cElementTree.parse(fn)
-            for e in et.getroot().getchildren():
-                if e.tag == '{http://www.openarchives.org/OAI/2.0/}ListRecords':
-                    for record in e.getchildren():
-                        if record.tag == '{http://www.openarchives.org/OAI/2.0/}record':
-                            meta = record.find('{http://www.openarchives.org/OAI/2.0/}metadata')
-
-                            idstr = ''.join(meta.find('.//{http://arxiv.org/OAI/arXivRaw/}id').itertext())
-                            vers = meta.findall('.//{http://arxiv.org/OAI/arXivRaw/}version')
-                            for v in vers:
-                                if v.get('version') == 'v1':
-                                    assert v[0].tag == '{http://arxiv.org/OAI/arXivRaw/}date'
-                                    datestr = ''.join(v[0].itertext())
-                                    break
-                            else:
-                                raise ValueError('No v1 found in record for id {0} in file {1}'.format(idstr, fn))
-
-                            #covert datestr to a datetime
-                            day, dt = datestr.split(',')
-
-                            day, monthstr, year, tme = dt.split()[:-1]  # last is "GMT"
-                            hr, mn, sec = [int(s) for s in tme.split(':')]
-                            dt = datetime(int(year), monthstrtonum[monthstr], int(day), hr, mn, sec)
-
-                            #insert into the db
-                            coll.insert({'arxiv_id': idstr, 'arxiv_date': dt, 'arxiv_day': day})
+        if nprocs > 1:
+            conn.close()
+            args = [(fn, dbname, collname, batchsize, verbose, resume, upsert) for fn in reclistfns]
+            pool = Pool(nprocs)
+            try:
+                summaries = pool.map(ingest_reclist_file_proc, args, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            manifest = conn[dbname][collname + '_manifest'] if resume else None
+            summaries = [ingest_reclist_file(fn, coll, batchsize, verbose, manifest, upsert) for fn in reclistfns]
+    finally:
+        conn.close()
 
-                    break
-            else:
-                raise ValueError('Could not find ListRecords elemnt in reclist file ' + fn)
+    res = {'files': summaries,
+           'nrecords': sum([smry['nrecords'] for smry in summaries]),
+           'nfailed': sum([smry['nfailed'] for smry in summaries]),
+           'nskipped': sum([smry['skipped'] for smry in summaries]),
+           'elapsed': time.time() - sttime}
+    if verbose:
+        print 'Inserted', res['nrecords'], 'records from', len(summaries), 'files in', res['elapsed'], 'sec.', res['nfailed'], 'failed.'
+        if resume:
+            print 'Skipped', res['nskipped'], 'files that were already ingested.'
+    return res
+
+
+def ingest_reclist_file_proc(args):
+    """
+    Runs `ingest_reclist_file` in a `Pool` worker with its own connection.
+    `args` is ``(fn, dbname, collname, batchsize, verbose, resume, upsert)``
+    """
+    from pymongo import MongoClient
+
+    fn, dbname, collname, batchsize, verbose, resume, upsert = args
+    conn = MongoClient()
+    try:
+        manifest = conn[dbname][collname + '_manifest'] if resume else None
+        return ingest_reclist_file(fn, conn[dbname][collname], batchsize, verbose, manifest, upsert)
     finally:
         conn.close()
 
 
-def get_cite_count_data_from_ads(arxivid, adsurl, urltimeout=5, urllst=None, etlst=None):
+def ingest_reclist_file(fn, coll, batchsize=1000, verbose=True, manifest=None, upsert=None):
+    """
+    Inserts the documents from the reclist file `fn` into `coll`, or upserts
+    them on ``arxiv_id`` if `upsert` is True (the default if `manifest` is
+    given).
+
+    If `manifest` is a collection, the file is recorded in it once it is
+    done - as ``complete`` only if no records failed.  A file that is
+    complete in `manifest` with the same size and mtime is skipped.  It is
+    only hashed when recorded, or if just its mtime changed, in which case it
+    is skipped if the hash still matches.
+
+    Returns a summary dictionary with the file name (``fn``), number of
+    records inserted/upserted (``nrecords``), records that failed to convert
+    or insert (``nfailed``), the time taken (``elapsed``), whether it was
+    ``skipped``, and the ``error`` that stopped the file, if any.
+    """
+    import time
+    import datetime
+
+    if upsert is None:
+        upsert = manifest is not None
+
+    sttime = time.time()
+    smry = {'fn': fn, 'nrecords': 0, 'nfailed': 0, 'error': None, 'skipped': False}
+
+    if manifest is not None:
+        info = reclist_file_info(fn)
+        entry = manifest.find_one({'fn': info['fn']})
+        unchanged = False
+        if entry is not None and entry.get('complete') and entry.get('size') == info['size']:
+            if entry.get('mtime') == info['mtime']:
+                unchanged = True
+            else:
+                info['sha1'] = file_sha1(fn)
+                if entry.get('sha1') == info['sha1']:
+                    # just touched - note the new mtime so it isn't hashed again
+                    manifest.update({'fn': info['fn']}, {'$set': {'mtime': info['mtime']}})
+                    unchanged = True
+        if unchanged:
+            if verbose:
+                print 'Skipping already ingested file', fn
+            smry['skipped'] = True
+            smry['elapsed'] = time.time() - sttime
+            return smry
+
+    if verbose:
+        print 'Populating db for file', fn
+
+    recerrors = []
+    docs = []
+    try:
+        for doc in iter_reclist_docs(fn, recerrors):
+            docs.append(doc)
+            if len(docs) >= batchsize:
+                smry['nrecords'] += bulk_insert(coll, docs, recerrors, upsert)
+                docs = []
+        if docs:
+            smry['nrecords'] += bulk_insert(coll, docs, recerrors, upsert)
+    except Exception as e:
+        smry['error'] = '{0}: {1}'.format(e.__class__.__name__, e)
+        print 'Error while ingesting', fn, '-', smry['error']
+    smry['nfailed'] = len(recerrors)
+    smry['elapsed'] = time.time() - sttime
+
+    if manifest is not None and smry['error'] is None:
+        if 'sha1' not in info:
+            info['sha1'] = file_sha1(fn)
+        info['complete'] = smry['nfailed'] == 0
+        info['nrecords'] = smry['nrecords']
+        info['nfailed'] = smry['nfailed']
+        info['ingested'] = datetime.datetime.utcnow()
+        manifest.update({'fn': info['fn']}, info, upsert=True)
+
+    return smry
+
+
+def reclist_file_info(fn):
+    """
+    Returns the absolute path, size and mtime of `fn` as a dictionary, for the
+    ingest manifest.
+    """
+    import os
+
+    st = os.stat(fn)
+    return {'fn': os.path.abspath(fn),
+            'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+def file_sha1(fn, blocksize=2**20):
+    """
+    The hex sha1 hash of the contents of `fn`
+    """
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha1.update(block)
+            block = f.read(blocksize)
+    return sha1.hexdigest()
+
+
+def bulk_insert(coll, docs, errors=None, upsert=False):
+    """
+    Inserts `docs` in an unordered bulk operation.  Returns the number
+    inserted - the error messages for documents that failed are appended to
+    `errors` if it is not None.
+
+    If `upsert` is True, each document is instead upserted on its
+    ``arxiv_id``, setting only the fields in the document.
+    """
+    from pymongo.errors import BulkWriteError
+
+    bulk = coll.initialize_unordered_bulk_op()
+    for doc in docs:
+        if upsert:
+            bulk.find({'arxiv_id': doc['arxiv_id']}).upsert().update_one({'$set': doc})
+        else:
+            bulk.insert(doc)
+
+    try:
+        res = bulk.execute()
+    except BulkWriteError as e:
+        if errors is not None:
+            errors.extend([we['errmsg'] for we in e.details['writeErrors']])
+        res = e.details
+
+    if upsert:
+        return res['nUpserted'] + res['nMatched']
+    else:
+        return res['nInserted']
+
+
+def iter_reclist_docs(fn, errors=None):
+    """
+    Yields the db documents (``arxiv_id``, ``arxiv_date`` and ``arxiv_day``)
+    for the records in the OAI reclist file `fn`.  The file is parsed
+    incrementally, and each record is thrown away once it has been yielded.
+
+    If `errors` is a list, records that can't be converted are skipped and
+    their error messages appended to it, rather than raising.
+    """
+    from xml.etree import cElementTree
+
+    depth = 0
+    listrecords = None
+    for event, elem in cElementTree.iterparse(fn, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2 and listrecords is None and elem.tag == '{http://www.openarchives.org/OAI/2.0/}ListRecords':
+                listrecords = elem
+        else:
+            if elem is listrecords:
+                # only the first ListRecords is used
+                return
+            if depth == 3 and listrecords is not None and elem.tag == '{http://www.openarchives.org/OAI/2.0/}record':
+                try:
+                    doc = reclist_record_to_doc(elem, fn)
+                except (ValueError, KeyError, AttributeError) as e:
+                    if errors is None:
+                        raise
+                    errors.append(str(e))
+                else:
+                    yield doc
+                listrecords.clear()
+            depth -= 1
+
+    if listrecords is None:
+        raise ValueError('Could not find ListRecords elemnt in reclist file ' + fn)
+
+
+def reclist_record_to_doc(record, fn=''):
+    """
+    Converts an OAI ``record`` element from a reclist into a db document
+    """
+    from datetime import datetime
+
+    meta = record.find('{http://www.openarchives.org/OAI/2.0/}metadata')
+
+    idstr = ''.join(meta.find('.//{http://arxiv.org/OAI/arXivRaw/}id').itertext())
+    vers = meta.findall('.//{http://arxiv.org/OAI/arXivRaw/}version')
+    for v in vers:
+        if v.get('version') == 'v1':
+            assert v[0].tag == '{http://arxiv.org/OAI/arXivRaw/}date'
+            datestr = ''.join(v[0].itertext())
+            break
+    else:
+        raise ValueError('No v1 found in record for id {0} in file {1}'.format(idstr, fn))
+
+    #covert datestr to a datetime
+    day, dt = datestr.split(',')
+
+    day, monthstr, year, tme = dt.split()[:-1]  # last is "GMT"
+    hr, mn, sec = [int(s) for s in tme.split(':')]
+    dt = datetime(int(year), monthstrtonum[monthstr], int(day), hr, mn, sec)
+
+    return {'arxiv_id': idstr, 'arxiv_date': dt, 'arxiv_day': day}
+
+
+def get_cite_count_data_from_ads(arxivid, adsurl, urltimeout=5, urllst=None, etlst=None, timings=None):
     """
     This gets run from process_data_from_ads
     `urllst` is a list that will be appended with the url if it is not
-    None, same for etlst with the cElementTree.
+    None, same for etlst with the cElementTree (which is only built if
+    `etlst` is given).  If `timings` is a dict, the time in sec spent on the
+    'fetch' and 'parse' are added to it.
     """
-    from urllib2 import urlopen
-    from xml.etree import cElementTree
+    import time
+    from httpfetch import fetch
+    from adsxml import iter_records
 
-    #arXiv IDs are either 'astro-ph/#####' or just '####.####' - in the latter case the bibcode has a 'arXiv:' in fron
-    url = '{adsurl}/cgi-bin/bib_query?{idbibcode}&data_type=SHORT_XML'
-    url = url.format(adsurl=adsurl, idbibcode=('arXiv:' + arxivid) if arxivid[:4].isdecimal() else arxivid)
+    url = ads_query_url(arxivid, adsurl)
 
     if urllst is not None:
         urllst.append(url)
-    urlobj = None
 
-    try:
-        urlobj = urlopen(url, timeout=urltimeout)
-        et = cElementTree.parse(urlobj)
-        if etlst is not None:
-            etlst.append(et)
-    finally:
-        if hasattr(urlobj, 'close'):
-            urlobj.close()
-
-    data = {}
-    citeelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}citations')
-    if citeelem is not None:
-        data['ncites'] = int(citeelem.itertext().next())
-    bibcodeelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}bibcode')
-    if bibcodeelem is not None:
-        data['bibcode'] = bibcodeelem.itertext().next()
-    titleelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}title')
-    if titleelem is not None:
-        data['title'] = titleelem.itertext().next()
-    fauthorelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}author')
-    if fauthorelem is not None:
-        data['fauthor'] = fauthorelem.itertext().next()
-    allauthorelems = et.findall('.//{http://ads.harvard.edu/schema/abs/1.1/references}author')
-    if allauthorelems:
-        data['allauthors'] = [e.itertext().next() for e in allauthorelems]
-    pubdateelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}pubdate')
-    if pubdateelem is not None:
-        data['pubdate'] = pubdateelem.itertext().next()
-
-    journalelem = et.find('.//{http://ads.harvard.edu/schema/abs/1.1/references}journal')
-    if journalelem is not None:
-        data['journal'] = jstr = journalelem.itertext().next()
-        data['onlyarxiv'] = jstr.startswith('eprint arXiv')
+    t0 = time.time()
+    body = fetch(url, timeout=urltimeout)
+    t1 = time.time()
+    if etlst is not None:
+        from StringIO import StringIO
+        from xml.etree import cElementTree
+
+        etlst.append(cElementTree.parse(StringIO(body)))
 
+    rec = next(iter_records(body), None)
+    data = {} if rec is None else rec.data()
+    if timings is not None:
+        timings['fetch'] = timings.get('fetch', 0) + t1 - t0
+        timings['parse'] = timings.get('parse', 0) + time.time() - t1
     return data
 
 
-def cite_count_proc(arxivid, adsurl, dbname, collname, waittime, laststarttime, outqueue):
+#the most records ADS returns for one nph-abs_connect query
+maxadsbatch = 100
+
+
+def get_cite_count_data_from_ads_batch(arxivids, adsurl, urltimeout=30, urllst=None, timings=None):
+    """
+    Like `get_cite_count_data_from_ads`, but gets the data for a whole block
+    of arxiv ids with a single ``nph-abs_connect`` query.
+
+    Parameters
+    ----------
+    arxivids : list of str
+        The arxiv ids to query for - ADS will not return more than
+        `maxadsbatch` at once, so more than that is a ValueError
+    adsurl : str
+        The base url for the ADS mirror to query
+    urltimeout : number
+        Timeout in sec for the query
+    urllst : list or None
+        If not None, the url will be appended to this
+    timings : dict or None
+        If not None, the time in sec spent on the 'fetch' and 'parse' are
+        added to this
+
+    Returns
+    -------
+    datas : dict
+        Maps each arxiv id ADS returned a record for to the data dictionary
+        `get_cite_count_data_from_ads` would give for it.  Ids that ADS did not
+        find are absent.
+    """
+    import time
+    from httpfetch import fetch
+    from adsxml import iter_records
+
+    if len(arxivids) > maxadsbatch:
+        raise ValueError('ADS only returns {0} records per query, not {1}'.format(maxadsbatch, len(arxivids)))
+    url = ads_query_url(arxivids, adsurl)
+
+    if urllst is not None:
+        urllst.append(url)
+
+    t0 = time.time()
+    body = fetch(url, timeout=urltimeout)
+    t1 = time.time()
+
+    # the eprintid is how we map the records back to the ids we asked for
+    idset = set(arxivids)
+    datas = {}
+    for rec in iter_records(body):
+        if rec.arxivid in idset:
+            datas[rec.arxivid] = rec.data()
+
+    if timings is not None:
+        timings['fetch'] = timings.get('fetch', 0) + t1 - t0
+        timings['parse'] = timings.get('parse', 0) + time.time() - t1
+    return datas
+
+
+def ads_query_url(arxivid, adsurl):
+    """
+    The url `get_cite_count_data_from_ads` queries the ADS mirror `adsurl` at
+    for `arxivid`, or `get_cite_count_data_from_ads_batch` does if `arxivid`
+    is a list of ids.
+    """
+    from urllib import urlencode
+
+    if not isinstance(arxivid, basestring):
+        params = [('db_key', 'all'),
+                  ('version', '1'),
+                  ('bibcode', 'arXiv:' + '\r\narXiv:'.join(arxivid)),
+                  ('data_type', 'SHORT_XML'),
+                  ('nr_to_return', str(len(arxivid))),
+                  ('start_nr', '1')]
+        return adsurl + '/cgi-bin/nph-abs_connect?' + urlencode(params)
+
+    #arXiv IDs are either 'astro-ph/#####' or just '####.####' - in the latter case the bibcode has a 'arXiv:' in fron
+    url = '{adsurl}/cgi-bin/bib_query?{idbibcode}&data_type=SHORT_XML'
+    return url.format(adsurl=adsurl, idbibcode=('arXiv:' + arxivid) if arxivid[:4].isdecimal() else arxivid)
+
+
+def ads_query_cached(arxivid, adsurl):
     """
-    This is run by ADSMirror as a subprocess
+    True if the response cache (see `httpfetch.configure_cache`) has the
+    answer to the query for `arxivid` (see `ads_query_url`), so the mirror
+    need not be waited on for it.
     """
+    from httpfetch import get_cache
+
+    cache = get_cache()
+    if cache is None:
+        return False
     try:
-        from pymongo import MongoClient
-        import time
-        import traceback
-        import pickle
-        from pickle import PicklingError
-        from cPickle import PicklingError as CPicklingError
+        url = ads_query_url(arxivid, adsurl)
+    except Exception:
+        return False  # the query itself will report what is wrong with it
+    return cache.has(url)
 
-        try:
-            dtime = time.time() - laststarttime
-            if dtime < waittime:
-                time.sleep(waittime - dtime)
-        except BaseException as e:
-            outqueue.put('error (while sleeping) before ' + arxivid)
-            outqueue.put(laststarttime)
-            try:
-                pickle.dumps(e)
-                outqueue.put(e)
-            except (PicklingError, CPicklingError, TypeError) as e2:
-                outqueue.put('Could not pickle error, string form:' + str(e))
-            outqueue.put(traceback.format_exc())
-            return
 
-        qstarttime = time.time()
-        urllst = []
-        try:
-            data = get_cite_count_data_from_ads(arxivid, adsurl, urllst=urllst)
-        except BaseException as e:
-            urlmsg = (' url:"' + urllst[0]) + '"' if len(urllst) > 0 else ''
-            outqueue.put('error (url) while getting ' + arxivid + urlmsg)
-            outqueue.put(qstarttime)
-            try:
-                pickle.dumps(e)
-                outqueue.put(e)
-            except (PicklingError, CPicklingError, TypeError) as e2:
-                outqueue.put('Could not pickle error, string form:' + str(e))
-            outqueue.put(traceback.format_exc())
-            return
+def _cache_counts():
+    from httpfetch import get_cache
 
-        conn = None
-        try:
-            conn = MongoClient()
-            coll = conn[dbname][collname]
+    cache = get_cache()
+    return None if cache is None else cache.counts()
+
+
+def _send_results(pipe, items, cachecounts):
+    """
+    Sends a job's `items` over `pipe`, along with how much this process's
+    response cache counts went up from `cachecounts` (from `_cache_counts`),
+    for `ADSMirror` to add to the parent's.
+    """
+    counts = _cache_counts()
+    if counts is not None and cachecounts is not None:
+        counts = dict([(nm, n - cachecounts[nm]) for nm, n in counts.iteritems()])
+    pipe.send((items, counts))
 
-            coll.update({'arxiv_id': arxivid}, {'$set': data})
-        except Exception as e:
-            BaseException.put('error (mongo) while setting ' + arxivid)
-            outqueue.put(qstarttime)
-            try:
-                pickle.dumps(e)
-                outqueue.put(e)
-            except (PicklingError, CPicklingError, TypeError) as e2:
-                outqueue.put('Could not pickle error, string form:' + str(e))
-            outqueue.put(traceback.format_exc())
-            return
-        finally:
-            if conn is not None:
-                conn.close()
-        endtime = time.time()
 
-        outqueue.put('success at doing ' + arxivid)
-        outqueue.put(qstarttime)
-        outqueue.put(endtime - qstarttime)
+def cite_count_proc(arxivid, adsurl, dbname, collname, waittime, laststarttime, pipe, storeresults=True, profilefn=None):
+    """
+    This is run by ADSMirror as a subprocess.  The things `cite_count_job`
+    puts on its queue are sent back as a list over `pipe` when it is done,
+    along with the counts of the response cache hits and misses (see
+    `_send_results`).
+
+    `arxivid` can also be a list of ids, in which case they are all fetched
+    in one query with `get_cite_count_data_from_ads_batch`, and on success the
+    list of ids ADS did not return is put on the queue after the timing.
+
+    If `storeresults` is False, the results are not written to the db but
+    instead put on the queue (after the timing) as a dict mapping id to data.
+    See `cite_count_job` for `profilefn`.
+    """
+    outqueue = ListQueue()
+    cachecounts = _cache_counts()
+    try:
+        cite_count_job(arxivid, adsurl, dbname, collname, waittime, laststarttime, outqueue, storeresults=storeresults, profilefn=profilefn)
     except BaseException as e:
         import traceback
         print 'UNHANDLEDEX',e
         traceback.print_exc()
         raise
+    finally:
+        _send_results(pipe, outqueue.items, cachecounts)
+        pipe.close()
+
+
+def cite_count_worker(adsurl, dbname, collname, pipe):
+    """
+    This is run by ADSMirror as a long-lived subprocess in persistent mode.
+
+    Receives ``(arxivid, waittime, laststarttime, storeresults, profilefn)`` jobs over
+    `pipe`, and for each sends back what `cite_count_proc` would have.  The
+    mongo client (and imports) are kept between jobs.  A job of None ends the
+    worker.
+    """
+    from pymongo import MongoClient
+
+    client = None
+    try:
+        while True:
+            job = pipe.recv()
+            if job is None:
+                break
+
+            arxivid, waittime, laststarttime, storeresults, profilefn = job
+            if storeresults and client is None:
+                client = MongoClient()
+            outqueue = ListQueue()
+            cachecounts = _cache_counts()
+            try:
+                cite_count_job(arxivid, adsurl, dbname, collname, waittime,
+                               laststarttime, outqueue, client, storeresults,
+                               profilefn)
+            except BaseException as e:
+                import traceback
+                print 'UNHANDLEDEX',e
+                traceback.print_exc()
+                _send_results(pipe, outqueue.items, cachecounts)
+                raise
+            _send_results(pipe, outqueue.items, cachecounts)
+    finally:
+        if client is not None:
+            client.close()
+
+
+class ListQueue(object):
+    """
+    A stand-in for a `multiprocessing.Queue` that just holds things in a list,
+    so a whole job's results can be sent over a pipe in one go.
+    """
+    def __init__(self, items=None):
+        self.items = [] if items is None else items
+
+    def put(self, item):
+        self.items.append(item)
+
+    def get_nowait(self):
+        if len(self.items) == 0:
+            raise queue.Empty
+        return self.items.pop(0)
+
+
+def cite_count_job(arxivid, adsurl, dbname, collname, waittime, laststarttime,
+                   outqueue, client=None, storeresults=True, profilefn=None):
+    """
+    Does the work for `cite_count_proc` and `cite_count_worker`: waits until
+    `waittime` after `laststarttime`, gets the data from ADS, and stores it in
+    the db.  Results and errors go onto `outqueue`, with a dict of the time
+    spent on the 'wait', 'fetch', 'parse' and 'store' last on success.
+
+    If the response cache already has the answer, there is no wait, and
+    `laststarttime` is sent back as the query start time so the mirror's
+    pacing is unchanged.
+
+    If `client` is None, a new `MongoClient` is opened (and closed) for this
+    job, otherwise `client` is used.  If `storeresults` is False, nothing is
+    written to the db and the data is put on `outqueue` instead.
+
+    If `profilefn` is not None, everything after the wait is run under
+    `cProfile`, and the profile is dumped to `profilefn`.
+    """
+    import time
+    import traceback
+
+    isbatch = not isinstance(arxivid, basestring)
+    if isbatch:
+        idlabel = 'batch of {0} ids starting with {1}'.format(len(arxivid), arxivid[0])
+    else:
+        idlabel = arxivid
+
+    cached = ads_query_cached(arxivid, adsurl)
+    waitstarttime = time.time()
+    try:
+        dtime = time.time() - laststarttime
+        if dtime < waittime and not cached:
+            time.sleep(waittime - dtime)
+    except BaseException as e:
+        outqueue.put('error (while sleeping) before ' + idlabel)
+        outqueue.put(laststarttime)
+        _put_error(outqueue, e, traceback.format_exc())
+        return
+    spans = {'wait': time.time() - waitstarttime}
+
+    pacedfrom = laststarttime if cached else None
+    if profilefn is None:
+        _cite_count_query(arxivid, idlabel, adsurl, dbname, collname, outqueue,
+                          client, storeresults, spans, pacedfrom)
+    else:
+        import cProfile
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            _cite_count_query(arxivid, idlabel, adsurl, dbname, collname, outqueue,
+                              client, storeresults, spans, pacedfrom)
+        finally:
+            prof.disable()
+            _dump_profile(prof, profilefn)
+
+
+def _dump_profile(prof, profilefn):
+    import os
+
+    dirfn = os.path.dirname(profilefn)
+    if not os.path.isdir(dirfn):
+        try:
+            os.makedirs(dirfn)
+        except OSError:  # another process may have just made it
+            pass
+    prof.dump_stats(profilefn)
+
+
+def aggregate_profiles(profiledir):
+    """
+    Combines the per-query profiles `ADSQuerier` wrote to `profiledir` into
+    one ``<mirror>.prof`` file per mirror in `profiledir`.
+
+    Returns a dict mapping the mirror's `ADSMirror.profilename` to its
+    `pstats.Stats`.
+    """
+    import os
+    import pstats
+
+    allstats = {}
+    for name in sorted(os.listdir(profiledir)):
+        subdir = os.path.join(profiledir, name)
+        if not os.path.isdir(subdir):
+            continue
+        fns = [os.path.join(subdir, fn) for fn in sorted(os.listdir(subdir)) if fn.endswith('.prof')]
+        if len(fns) == 0:
+            continue
+        stats = pstats.Stats(*fns)
+        stats.dump_stats(os.path.join(profiledir, name + '.prof'))
+        allstats[name] = stats
+    return allstats
+
+
+def _put_error(outqueue, e, tb):
+    """
+    Puts the error `e` (or its string form if it can't be pickled) and the
+    traceback `tb` on `outqueue`
+    """
+    import pickle
+    from pickle import PicklingError
+    from cPickle import PicklingError as CPicklingError
+
+    try:
+        pickle.dumps(e)
+        outqueue.put(e)
+    except (PicklingError, CPicklingError, TypeError) as e2:
+        outqueue.put('Could not pickle error, string form:' + str(e))
+    outqueue.put(tb)
+
+
+def _cite_count_query(arxivid, idlabel, adsurl, dbname, collname, outqueue,
+                      client, storeresults, spans, pacedfrom=None):
+    """
+    The part of `cite_count_job` after the wait.  `spans` gets the time spent
+    on each stage.  If `pacedfrom` is not None, it is sent back as the query
+    start time instead of the real one.
+    """
+    import time
+    import traceback
+
+    isbatch = not isinstance(arxivid, basestring)
+
+    qstarttime = time.time()
+    sentstarttime = qstarttime if pacedfrom is None else pacedfrom
+    urllst = []
+    try:
+        if isbatch:
+            datas = get_cite_count_data_from_ads_batch(arxivid, adsurl, urllst=urllst, timings=spans)
+        else:
+            datas = {arxivid: get_cite_count_data_from_ads(arxivid, adsurl, urllst=urllst, timings=spans)}
+    except BaseException as e:
+        urlmsg = (' url:"' + urllst[0]) + '"' if len(urllst) > 0 else ''
+        outqueue.put('error (url) while getting ' + idlabel + urlmsg)
+        outqueue.put(sentstarttime)
+        _put_error(outqueue, e, traceback.format_exc())
+        return
+
+    conn = None
+    storestarttime = time.time()
+    try:
+        if storeresults:
+            if client is None:
+                from pymongo import MongoClient
+
+                client = conn = MongoClient()
+            coll = client[dbname][collname]
+
+            for aid, data in datas.iteritems():
+                coll.update({'arxiv_id': aid}, ads_data_update(data))
+    except Exception as e:
+        outqueue.put('error (mongo) while setting ' + idlabel)
+        outqueue.put(sentstarttime)
+        _put_error(outqueue, e, traceback.format_exc())
+        return
+    finally:
+        if conn is not None:
+            conn.close()
+    endtime = time.time()
+    if storeresults:
+        spans['store'] = endtime - storestarttime
+
+    outqueue.put('success at doing ' + idlabel)
+    outqueue.put(sentstarttime)
+    outqueue.put(endtime - qstarttime)
+    if isbatch:
+        outqueue.put([aid for aid in arxivid if aid not in datas])
+    if not storeresults:
+        outqueue.put(datas)
+    outqueue.put(spans)
 
 
 class ADSMirror(object):
-    def __init__(self, mirrorurl, mirrorname=''):
+    def __init__(self, mirrorurl, mirrorname='', persistent=False):
+        """
+        If `persistent` is True, queries are done by a single long-lived
+        `cite_count_worker` process instead of a new process for every query.
+        """
         self.url = mirrorurl
         self.name = mirrorname
+        self.persistent = persistent
 
         self.proc = self.queue = None
-
-        self.currarxivid = None
+        self.worker = self.pipe = None
+        self.workerdb = None  # the (dbname, collname) the worker is using
+        self.jobpending = False
+
+        self.currarxivid = None  # a list of ids if a batch is in progress
+        self.lastarxivid = None  # what the last successful query was for
+        self.jobstarttime = None  # when the current query was handed out
+        self.missingids = []  # ids the last batch did not find
+        self.storeresults = True
+        self.results = None  # id -> data dict, if the worker is not storing them
         self.prevqtime = -float('inf')  # the time the last query finished
         self.qprocessingtime = []
         self.qtimestamp = []
@@ -390,6 +982,19 @@ class ADSMirror(object):
         self.error = None
         self.errornoted = False
         self.timeoutcount = 0
+        self.breaker = None  # a `CircuitBreaker`, if there is one
+        self.metrics = None  # a `HarvestMetrics`, if there is one
+        self.stagetimes = {}  # 'wait', 'fetch', 'parse' and 'store' times of the last query
+        self.qstagetimes = []
+
+        # see `ADSQuerier` for these
+        self.profilefrac = 0
+        self.profiledir = None
+        self.nprofiled = 0
+
+        # adaptive pacing - see `set_adaptive_wait`
+        self.waittime = None
+        self.adaptive = False
 
     @property
     def readablename(self):
@@ -406,81 +1011,329 @@ class ADSMirror(object):
         self.error = error
         self.errornoted = False
 
-    def spawn_arxiv_proc(self, arxivid, dbname, collname, waittime):
+    def spawn_arxiv_proc(self, arxivid, dbname, collname, waittime, storeresults=True):
         """
         Does the work for this mirror, including waiting until the given
-        `waittime` has passed.
+        `waittime` has passed.  `arxivid` can be a list of ids to fetch them
+        as a batch.
+
+        If `storeresults` is False, the results are not written to the db, but
+        are instead put in `results` once `check_ready` sees they are done.
 
         If it errors, will set self.error to whatever the error was
         """
-        from multiprocessing import Process, Queue
+        import time
+        from multiprocessing import Process, Pipe
 
         if not self.check_ready():
             raise ValueError('Cannot spawn arxiv process if not ready')
 
         self.currarxivid = arxivid
+        self.jobstarttime = time.time()
+        self.storeresults = storeresults
+        profilefn = self.next_profile_fn()
+
+        if self.persistent:
+            if self.worker is None or not self.worker.is_alive() or self.workerdb != (dbname, collname):
+                self.start_worker(dbname, collname)
+            self.pipe.send((arxivid, waittime, self.prevqtime, storeresults, profilefn))
+            self.jobpending = True
+        else:
+            self.pipe, childpipe = Pipe(False)
+            self.proc = Process(target=cite_count_proc, args=(arxivid, self.url, dbname, collname, waittime, self.prevqtime, childpipe, storeresults, profilefn))
+            self.proc.start()
+            childpipe.close()  # so the pipe shows EOF if the process dies
 
-        self.queue = Queue()
-        self.proc = Process(target=cite_count_proc, args=(arxivid, self.url, dbname, collname, waittime, self.prevqtime, self.queue))
-        self.proc.start()
+    @property
+    def profilename(self):
+        """
+        `readablename` cleaned up for use as a directory name
+        """
+        import re
 
-    def check_ready(self):
+        return re.sub(r'\W+', '_', self.readablename).strip('_')
+
+    def next_profile_fn(self):
         """
-        returns True if the process is ready, False otherwise.
-        Also retrieves queue info and joins
+        The file to dump a profile of the next query to, or None if it should
+        not be profiled (which is decided at random, see `ADSQuerier`)
         """
-        import datetime
-        import traceback
+        import os
+        import random
 
-        if self.proc is not None:
-            if self.proc.is_alive():
-                return False
-            else:
-                try:
-                    self.proc.join()
-                    msg = self.queue.get_nowait()
-                    self.prevqtime = self.queue.get_nowait()
-                    if msg.startswith('success'):
-                        self.currarxivid = None
-                        self.qtimestamp.append(datetime.datetime.now())
-                        self.qprocessingtime.append(self.queue.get_nowait())
-                        self.timeoutcount = 0
-                    if msg.startswith('error'):
-                        error = self.queue.get_nowait()
-                        tb = self.queue.get_nowait()
-                        self.error = (msg, error, tb)
-                        # if a timeout error, increment the count
-                        if self.timed_out():
-                            self.timeoutcount += 1
-                    self.proc = None
-                except Exception as e:
-                    self.error = ('Exception while checking results', e, traceback.format_exc())
-        return self.error is None  # ready if proc is None and there is no error
+        if self.profiledir is None or random.random() >= self.profilefrac:
+            return None
+        self.nprofiled += 1
+        fn = '{0}-{1}.prof'.format(os.getpid(), self.nprofiled)
+        return os.path.join(self.profiledir, self.profilename, fn)
 
-    def timed_out(self):
+    def start_worker(self, dbname, collname):
         """
-        Returns True if there is currently an error caused by a timeout, False
-        otherwise
+        Starts (or restarts) the `cite_count_worker` process for persistent mode
         """
-        import socket
-        from urllib2 import URLError
+        from multiprocessing import Process, Pipe
 
-        issockto = isinstance(self.error[1], socket.timeout)
-        urlwithsockto = isinstance(self.error[1], URLError) and isinstance(self.error[1].args[0], socket.timeout)
+        if self.worker is not None:
+            self.stop_worker()
 
-        return issockto or urlwithsockto
+        self.pipe, childpipe = Pipe()
+        self.worker = Process(target=cite_count_worker, args=(self.url, dbname, collname, childpipe))
+        self.worker.daemon = True
+        self.worker.start()
+        childpipe.close()  # so the pipe shows EOF if the worker dies
+        self.workerdb = (dbname, collname)
 
-    def terminate_proc(self):
-        if self.proc is not None:
+    def stop_worker(self):
+        """
+        Asks the persistent worker to finish up, and kills it if it doesn't
+        """
+        if self.worker is None:
+            return
+
+        if self.worker.is_alive():
+            if self.jobpending:
+                self.worker.terminate()
+            else:
+                try:
+                    self.pipe.send(None)
+                except (IOError, OSError):
+                    self.worker.terminate()
+        self.worker.join()
+        self.pipe.close()
+        self.worker = self.pipe = self.workerdb = None
+        self.jobpending = False
+
+    def check_ready(self):
+        """
+        returns True if the process is ready, False otherwise.
+        Also retrieves queue info and joins
+        """
+        import traceback
+
+        if self.proc is not None or self.jobpending:
+            if self.jobpending:
+                if self.worker.is_alive() and not self.pipe.poll():
+                    return False
+            elif self.proc.is_alive() and not self.pipe.poll():
+                return False
+
+            try:
+                # if the process died without answering this gives an empty queue
+                self.queue = ListQueue(self._recv_results())
+                if self.jobpending:
+                    self.jobpending = False
+                else:
+                    self.proc.join()
+                    self.pipe.close()
+                    self.pipe = None
+                msg = self.queue.get_nowait()
+                self.prevqtime = self.queue.get_nowait()
+                if msg.startswith('success'):
+                    qprocessingtime = self.queue.get_nowait()
+                    if isinstance(self.currarxivid, list):
+                        self.missingids = self.queue.get_nowait()
+                    if not self.storeresults:
+                        self.results = self.queue.get_nowait()
+                    stagetimes = self.queue.get_nowait()
+                    self.lastarxivid = self.currarxivid
+                    self.currarxivid = None
+                    self.record_success(qprocessingtime, stagetimes, len(self.missingids))
+                if msg.startswith('error'):
+                    error = self.queue.get_nowait()
+                    tb = self.queue.get_nowait()
+                    self.record_error((msg, error, tb))
+                self.proc = None
+            except Exception as e:
+                self.error = ('Exception while checking results', e, traceback.format_exc())
+        return self.error is None  # ready if proc is None and there is no error
+
+    def record_success(self, qprocessingtime, stagetimes, nmissing=0):
+        """
+        Notes that a query succeeded after `qprocessingtime` sec, with
+        `stagetimes` the time spent on each stage and `nmissing` the ids ADS
+        did not find
+        """
+        import datetime
+
+        self.qtimestamp.append(datetime.datetime.now())
+        self.qprocessingtime.append(qprocessingtime)
+        self.stagetimes = stagetimes
+        self.qstagetimes.append(stagetimes)
+        self.timeoutcount = 0
+        if self.breaker is not None:
+            self.breaker.record_success()
+        if self.adaptive:
+            self.adapt_waittime()
+        if self.metrics is not None:
+            self.metrics.record_query(self, 'success', nmissing, stagetimes)
+
+    def record_error(self, error):
+        """
+        Notes that a query failed with `error`, a ``(msg, errorobj, tb)``
+        tuple, which becomes the current `error`
+        """
+        self.set_error(error)
+        if self.timed_out():
+            self.timeoutcount += 1
+        if self.adaptive:
+            self.adapt_waittime()
+        if self.metrics is not None:
+            self.metrics.record_query(self, self.error_kind())
+
+    def _recv_results(self):
+        """
+        The list of results from the worker, or None if there aren't any.  The
+        worker's response cache counts are added to this process's cache.
+        """
+        from httpfetch import get_cache
+
+        try:
+            if not self.pipe.poll():
+                return None
+            items, cachecounts = self.pipe.recv()
+        except EOFError:
+            return None
+        cache = get_cache()
+        if cache is not None and cachecounts is not None:
+            cache.add_counts(cachecounts)
+        return items
+
+    def result_handle(self):
+        """
+        The pipe the results of the current query will come back on (for
+        waiting on with ``select``), or None if there is no query running
+        """
+        if self.jobpending or self.proc is not None:
+            return self.pipe
+        return None
+
+    def timed_out(self):
+        """
+        Returns True if there is currently an error caused by a timeout, False
+        otherwise
+        """
+        import socket
+        from urllib2 import URLError
+
+        issockto = isinstance(self.error[1], socket.timeout)
+        # an HTTPError is a URLError too, but has no `reason` to look at
+        urlwithsockto = isinstance(self.error[1], URLError) and isinstance(getattr(self.error[1], 'reason', None), socket.timeout)
+
+        return issockto or urlwithsockto
+
+    def http_error_code(self):
+        """
+        Returns the HTTP status code of the current error, or None if it is not
+        an HTTP error.  Works on the string form the error often comes back as.
+        """
+        import re
+        from urllib2 import HTTPError
+
+        if isinstance(self.error[1], HTTPError):
+            return self.error[1].code
+        match = re.search(r'HTTP Error (\d+)', str(self.error[1]))
+        return int(match.group(1)) if match else None
+
+    def network_error(self):
+        """
+        Returns True if the current error is from talking to the mirror (an
+        HTTP error, a timeout or a connection problem), as opposed to, say, a
+        failed db write.
+        """
+        import socket
+        import httplib
+        from urllib2 import URLError
+
+        if self.timed_out() or self.http_error_code() is not None:
+            return True
+        error = self.error[1]
+        if isinstance(error, (URLError, socket.error, httplib.HTTPException)):
+            return True
+        # the string form, if it couldn't be pickled
+        return isinstance(error, basestring) and 'urlopen error' in error
+
+    def error_kind(self):
+        """
+        'notfound', 'timeout' or 'error', for the current error
+        """
+        if self.timed_out():
+            return 'timeout'
+        elif self.http_error_code() == 404:
+            return 'notfound'
+        return 'error'
+
+    def set_adaptive_wait(self, waittime, floor=15, ceiling=600, step=1,
+                          backoff=2, slowfactor=2, nhistory=20):
+        """
+        Turns on adaptive pacing: the time between queries starts at
+        `waittime`, and after each query `adapt_waittime` shrinks it by `step`
+        sec if things went well, grows it by `step` if the query was more than
+        `slowfactor` times slower than the median of the last `nhistory`, and
+        multiplies it by `backoff` after a timeout or an HTTP error that looks
+        like the mirror pushing back.  It always stays between `floor` and
+        `ceiling`.
+        """
+        self.adaptive = True
+        self.waittime = waittime
+        self.waitfloor = floor
+        self.waitceiling = ceiling
+        self.waitstep = step
+        self.waitbackoff = backoff
+        self.slowfactor = slowfactor
+        self.nhistory = nhistory
+
+    def adapt_waittime(self):
+        """
+        Adjusts `waittime` based on the outcome of the query that just finished
+        (the current `error`, or the last `qprocessingtime` if there is none).
+        Returns the new `waittime`.
+        """
+        from numpy import median
+
+        oldwait = self.waittime
+        if self.error is None:
+            history = self.qprocessingtime[-self.nhistory - 1:-1]
+            if len(history) > 0 and self.qprocessingtime[-1] > self.slowfactor * median(history):
+                reason = 'slow query ({0:.2f} sec)'.format(self.qprocessingtime[-1])
+                newwait = oldwait + self.waitstep
+            else:
+                reason = 'successful query'
+                newwait = oldwait - self.waitstep
+        else:
+            code = self.http_error_code()
+            if self.timed_out():
+                reason = 'timeout'
+            elif code is not None and (code in (403, 429) or code >= 500):
+                reason = 'HTTP error {0}'.format(code)
+            else:  # e.g. a 404 says nothing about how the mirror is doing
+                return oldwait
+            newwait = oldwait * self.waitbackoff
+
+        self.waittime = min(max(newwait, self.waitfloor), self.waitceiling)
+        if self.waittime != oldwait:
+            print 'Adjusted wait time for', self, 'from', oldwait, 'to', self.waittime, 'sec after', reason
+        return self.waittime
+
+    def terminate_proc(self):
+        if self.proc is not None:
             try:
                 rdy = self.check_ready()
             except:
                 #probably a queue problem
                 rdy = None
-            if not rdy:
+            if not rdy and self.proc is not None:
                 self.proc.terminate()
                 self.proc.join()  # de-zombify
             self.proc = None
+            if self.pipe is not None and self.worker is None:
+                self.pipe.close()
+                self.pipe = None
+        if self.worker is not None:
+            try:
+                self.check_ready()
+            except:
+                pass
+            self.stop_worker()
 
     def time_stats(self):
         from numpy import array
@@ -490,12 +1343,703 @@ class ADSMirror(object):
 
         return ptarr.mean(), ptarr.std(), ptarr, tsarr
 
+    def stage_stats(self):
+        """
+        Returns a dict mapping each of 'wait', 'fetch', 'parse' and 'store' to
+        the mean and standard deviation of the time spent on it.
+        """
+        from numpy import array
+
+        stats = {}
+        for stage in ('wait', 'fetch', 'parse', 'store'):
+            arr = array([st[stage] for st in self.qstagetimes if stage in st])
+            if len(arr) > 0:
+                stats[stage] = (arr.mean(), arr.std())
+        return stats
+
+
+class CircuitBreaker(object):
+    """
+    Takes a failing `ADSMirror` out of service and brings it back once it
+    recovers, instead of deactivating it for good.
+
+    The circuit starts 'closed' (in service).  `trip` opens it, which starts
+    a thread that GETs the mirror's front page every `probeinterval` sec
+    (doubling after each failed probe, up to `maxprobeinterval`), giving up
+    on a probe after `probetimeout` sec.  After a successful probe the
+    circuit is 'half-open': the querier lets one real query through, which
+    closes the circuit (`record_success`) if it works or opens it again if
+    it does not.  Each time a half-open circuit opens again, probing starts
+    at twice the previous interval.  After `maxreopens` failed trial queries
+    in a row, the breaker gives up (`givenup`) and stops probing.
+    """
+    def __init__(self, mirror, probeinterval=300, maxprobeinterval=3600, probetimeout=10,
+                 maxreopens=3):
+        import threading
+
+        self.mirror = mirror
+        self.probeinterval = probeinterval
+        self.maxprobeinterval = maxprobeinterval
+        self.probetimeout = probetimeout
+        self.maxreopens = maxreopens
+
+        self.state = 'closed'
+        self.givenup = False
+        self.ntrips = 0
+        self.nprobes = 0
+        self.nreopened = 0  # times it went half-open -> open since last closed
+        self.openedtime = None
+
+        self.lock = threading.Lock()
+        self.stopevent = threading.Event()
+        self.thread = None
+
+    def __repr__(self):
+        return '<CircuitBreaker: {0} {1}>'.format(self.mirror.readablename, self.state)
+
+    def trip(self):
+        """
+        Opens the circuit and starts probing, unless it's already open
+        """
+        import time
+        import threading
+
+        with self.lock:
+            if self.state == 'open':
+                return
+            if self.state == 'halfopen':
+                self.nreopened += 1
+            self.state = 'open'
+            self.ntrips += 1
+            self.openedtime = time.time()
+            if self.nreopened >= self.maxreopens:
+                self.givenup = True
+
+        if self.givenup:
+            print 'Giving up on', self.mirror, 'after', self.nreopened, 'failed trial queries'
+            return
+
+        interval = min(self.probeinterval * 2 ** self.nreopened, self.maxprobeinterval)
+        print 'Opened circuit for', self.mirror, '- probing every', interval, 'sec'
+
+        self.stopevent.clear()
+        self.thread = threading.Thread(target=self._probe_loop, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _probe_loop(self, interval):
+        while not self.stopevent.wait(interval):
+            if self.probe():
+                with self.lock:
+                    if self.state == 'open':
+                        self.state = 'halfopen'
+                print 'Health probe of', self.mirror, 'succeeded - circuit half-open'
+                return
+            interval = min(interval * 2, self.maxprobeinterval)
+
+    def probe(self):
+        """
+        Returns True if the mirror answers a cheap request
+        """
+        from urllib2 import HTTPError
+        from httpfetch import fetch
+
+        self.nprobes += 1
+        try:
+            fetch(self.mirror.url.strip() + '/', self.probetimeout, usecache=False)
+        except HTTPError as e:
+            # it's up if it's just saying it doesn't have the page
+            return e.code < 500 and e.code not in (403, 429)
+        except Exception:
+            return False
+        return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            self.state = 'closed'
+            self.nreopened = 0
+        self.stop()
+        print 'Closed circuit for', self.mirror
+
+    def stop(self):
+        """
+        Stops any probing (without changing the state)
+        """
+        self.stopevent.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def reset(self):
+        self.stop()
+        with self.lock:
+            self.state = 'closed'
+            self.givenup = False
+            self.nreopened = 0
+
+    def may_recover(self):
+        """
+        True if the circuit is open or half-open and not given up on, so the
+        mirror may yet come back into service
+        """
+        return self.state != 'closed' and not self.givenup
+
+
+class LatencyScheduler(object):
+    """
+    Decides how `ADSQuerier.main_loop` hands out work based on how fast each
+    mirror has been:
+
+    * Batches are sized in proportion to each mirror's expected throughput.
+    * Near the end of the queue, a mirror holds off if enough faster mirrors
+      will be done with the remaining IDs before it would be.
+    * Once the queue is empty, an idle mirror re-does the query of a mirror
+      that is stuck at more than `stragglerfactor` times its usual time.  The
+      first result to come back wins, and the other is dropped.
+
+    `querier` is the `ADSQuerier`, and `nhistory` is how many recent queries
+    are used for a mirror's typical time.
+    """
+    def __init__(self, querier, stragglerfactor=3, nhistory=20):
+        self.querier = querier
+        self.stragglerfactor = stragglerfactor
+        self.nhistory = nhistory
+
+        self.speculated = set()  # ids being done by more than one mirror
+        self.doneids = set()  # the speculated ids that are done
+
+    def processing_time(self, m):
+        """
+        The expected time for a query to `m` once it starts (not counting the
+        wait) - the mean of the recent ones, or of all mirrors' recent ones if
+        `m` has none.
+        """
+        from numpy import mean
+
+        if len(m.qprocessingtime) > 0:
+            return mean(m.qprocessingtime[-self.nhistory:])
+        alltimes = []
+        for mi in self.querier.mirrors:
+            alltimes.extend(mi.qprocessingtime[-self.nhistory:])
+        return mean(alltimes) if alltimes else 0
+
+    def job_time(self, m):
+        """
+        Expected time per query for `m` in steady state
+        """
+        return self.querier.mirror_waittime(m) + self.processing_time(m)
+
+    def is_straggling(self, m, now):
+        if m.currarxivid is None or m.jobstarttime is None:
+            return False
+        return (now - m.jobstarttime) > self.stragglerfactor * self.job_time(m)
+
+    def next_finish(self, m, now):
+        """
+        When `m` would finish a new query if it were handed one as soon as it
+        is free.
+        """
+        wait = self.querier.mirror_waittime(m)
+        proc = self.processing_time(m)
+
+        if m.currarxivid is not None:
+            currstart = max(m.jobstarttime, m.prevqtime + wait)
+            free = max(now, currstart + proc)
+            start = max(free, currstart + wait)
+        else:
+            start = max(now, m.prevqtime + wait)
+        return start + proc
+
+    def batch_size(self, m, maxbatch):
+        """
+        `maxbatch` (or `maxadsbatch`, if that is less) for the fastest active
+        mirror, proportionally less for the slower ones.
+        """
+        maxbatch = min(maxbatch, maxadsbatch)
+        if maxbatch <= 1:
+            return maxbatch
+
+        fastest = min([self.job_time(mi) for mi in self.querier.mirrors if mi.error is None] + [self.job_time(m)])
+        if fastest <= 0:
+            return maxbatch
+        return min(maxbatch, max(1, int(round(maxbatch * fastest / self.job_time(m)))))
+
+    def should_defer(self, m, nqueued, now):
+        """
+        True if `m` should not take any of the `nqueued` remaining IDs, because
+        other mirrors will finish them all sooner.
+        """
+        others = [mi for mi in self.querier.mirrors if mi is not m and mi.error is None
+                  and not self.is_straggling(mi, now)]
+        if nqueued >= len(others) + 1:
+            return False
+
+        mfinish = self.next_finish(m, now)
+        nfaster = sum([self.next_finish(mi, now) < mfinish for mi in others])
+        return nfaster >= nqueued
+
+    def find_straggler(self, m, now):
+        """
+        Returns the most overdue mirror whose query `m` should re-do, or None
+        """
+        best = None
+        bestoverdue = 0
+        for mi in self.querier.mirrors:
+            if mi is m or not self.is_straggling(mi, now):
+                continue
+            ids = mi.currarxivid if isinstance(mi.currarxivid, list) else [mi.currarxivid]
+            if any([aid in self.speculated for aid in ids]):
+                continue  # already being re-done
+
+            overdue = (now - mi.jobstarttime) / self.job_time(mi)
+            if overdue > bestoverdue:
+                best = mi
+                bestoverdue = overdue
+        return best
+
+    def speculate(self, ids):
+        self.speculated.update(ids)
+
+    def not_done(self, ids):
+        """
+        The ones from `ids` that have not already been done by another mirror
+        """
+        return [aid for aid in ids if aid not in self.doneids]
+
+    def complete(self, ids):
+        """
+        Records that `ids` have been done.  Returns the ones that had not
+        already been done by another mirror.
+        """
+        newids = self.not_done(ids)
+        self.doneids.update([aid for aid in ids if aid in self.speculated])
+        return newids
+
+    def finished_elsewhere(self, m):
+        """
+        True if everything `m` is working on has been done by other mirrors
+        """
+        if m.currarxivid is None:
+            return False
+        ids = m.currarxivid if isinstance(m.currarxivid, list) else [m.currarxivid]
+        return len(self.not_done(ids)) == 0
+
+
+class MongoWriteBuffer(object):
+    """
+    Collects ADS results and writes them to the db in unordered bulk updates,
+    either once `flushcount` of them have piled up or `flushtime` sec after the
+    last flush, whichever comes first.
+    """
+    def __init__(self, coll, flushcount=100, flushtime=30):
+        import time
+
+        self.coll = coll
+        self.flushcount = flushcount
+        self.flushtime = flushtime
+
+        self.pending = []  # (arxivid, data) pairs
+        self.lastflushtime = time.time()
+        self.nwritten = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, arxivid, data):
+        self.pending.append((arxivid, data))
+
+    def flush_due(self):
+        import time
+
+        if len(self.pending) == 0:
+            return False
+        return (len(self.pending) >= self.flushcount or
+                (time.time() - self.lastflushtime) >= self.flushtime)
+
+    def flush_if_due(self):
+        """
+        Flushes if it is time to - returns the failures from `flush`
+        """
+        return self.flush() if self.flush_due() else []
+
+    def flush(self):
+        """
+        Writes out everything pending.
+
+        Returns a list of ``(arxivid, errmsg)`` for the documents that failed
+        to update - the rest are written regardless.
+        """
+        import time
+        from pymongo.errors import BulkWriteError
+
+        self.lastflushtime = time.time()
+        if len(self.pending) == 0:
+            return []
+
+        pending = self.pending
+        self.pending = []
+
+        bulk = self.coll.initialize_unordered_bulk_op()
+        for arxivid, data in pending:
+            bulk.find({'arxiv_id': arxivid}).update_one(ads_data_update(data))
+
+        try:
+            bulk.execute()
+            failures = []
+        except BulkWriteError as e:
+            failures = [(pending[we['index']][0], we['errmsg']) for we in e.details['writeErrors']]
+
+        self.nwritten += len(pending) - len(failures)
+        return failures
+
+
+class HarvestMetrics(object):
+    """
+    Counts and timings for a harvest run, written out every `interval` sec
+    (by `write_if_due`) as a line of JSON appended to `jsonfn` and/or as a
+    Prometheus textfile-collector file at `promfn`.
+
+    For each mirror this keeps the number of queries ('requests'), how many
+    succeeded, 404'd, timed out, or failed some other way, and the number of
+    IDs ADS did not find ('missing').  The time spent in each of the 'fetch',
+    'parse' and 'store' stages goes in a histogram with bucket upper edges
+    `buckets`.  `set_progress` fills in the queue depth and estimated time
+    to completion.
+    """
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+    counternames = ('requests', 'success', 'notfound', 'timeout', 'error', 'missing')
+
+    def __init__(self, jsonfn=None, promfn=None, interval=60):
+        import time
+
+        self.jsonfn = jsonfn
+        self.promfn = promfn
+        self.interval = interval
+
+        self.counters = {}  # mirror name -> counter name -> count
+        self.histograms = {}  # (mirror name, stage) -> [bucket counts, sum, count]
+        self.progress = {}
+        self.starttime = self.lastwritetime = time.time()
+
+    def _mirror_counters(self, name):
+        if name not in self.counters:
+            self.counters[name] = dict([(cnm, 0) for cnm in self.counternames])
+        return self.counters[name]
+
+    def record_query(self, m, outcome, nmissing=0, stagetimes=None):
+        """
+        Records a query by the `ADSMirror` `m`.  `outcome` is 'success' or one
+        of the `ADSMirror.error_kind` values.
+        """
+        counters = self._mirror_counters(m.readablename)
+        counters['requests'] += 1
+        counters[outcome] += 1
+        counters['missing'] += nmissing
+        if stagetimes:
+            for stage, secs in stagetimes.iteritems():
+                self.record_stage(m.readablename, stage, secs)
+
+    def record_stage(self, name, stage, secs):
+        from bisect import bisect_left
+
+        hist = self.histograms.get((name, stage))
+        if hist is None:
+            hist = self.histograms[name, stage] = [[0] * len(self.buckets), 0., 0]
+        hist[0][bisect_left(self.buckets, secs)] += 1
+        hist[1] += secs
+        hist[2] += 1
+
+    def set_progress(self, queued, inflight, failed, ndone):
+        """
+        Updates the queue depth and progress, and from them the estimated time
+        to completion
+        """
+        import time
+
+        elapsed = time.time() - self.starttime
+        self.progress = {'queued': queued,
+                         'inflight': inflight,
+                         'failed': failed,
+                         'done': ndone,
+                         'elapsed': elapsed,
+                         'eta': elapsed / ndone * (queued + inflight) if ndone > 0 else None}
+
+    def snapshot(self):
+        """
+        Everything as a JSON-friendly dict
+        """
+        import time
+
+        mirrors = {}
+        for name, counters in self.counters.iteritems():
+            mirrors[name] = dict(counters)
+        for (name, stage), (bucketcounts, total, n) in self.histograms.iteritems():
+            hists = mirrors.setdefault(name, {}).setdefault('stages', {})
+            hists[stage] = {'buckets': list(bucketcounts), 'sum': total, 'count': n}
+        return {'time': time.time(),
+                'buckets': [str(b) for b in self.buckets],
+                'mirrors': mirrors,
+                'progress': self.progress}
+
+    def prometheus_text(self):
+        """
+        Everything in the Prometheus text exposition format
+        """
+        def esc(name):
+            return name.replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = []
+        for cnm in self.counternames:
+            metric = 'citestats_mirror_{0}_total'.format(cnm)
+            lines.append('# TYPE {0} counter'.format(metric))
+            for name in sorted(self.counters):
+                lines.append('{0}{{mirror="{1}"}} {2}'.format(metric, esc(name), self.counters[name][cnm]))
+
+        metric = 'citestats_stage_seconds'
+        lines.append('# TYPE {0} histogram'.format(metric))
+        for (name, stage) in sorted(self.histograms):
+            bucketcounts, total, n = self.histograms[name, stage]
+            labels = 'mirror="{0}",stage="{1}"'.format(esc(name), stage)
+            cumcount = 0
+            for edge, count in zip(self.buckets, bucketcounts):
+                cumcount += count
+                le = '+Inf' if edge == float('inf') else repr(edge)
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(metric, labels, le, cumcount))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(metric, labels, total))
+            lines.append('{0}_count{{{1}}} {2}'.format(metric, labels, n))
+
+        for key, value in sorted(self.progress.iteritems()):
+            if value is not None:
+                metric = 'citestats_{0}{1}'.format(key, '_seconds' if key in ('elapsed', 'eta') else '')
+                lines.append('# TYPE {0} gauge'.format(metric))
+                lines.append('{0} {1!r}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Appends to `jsonfn` and rewrites `promfn` (atomically, as the
+        textfile collector may read it at any time)
+        """
+        import os
+        import time
+        import json
+
+        if self.jsonfn is not None:
+            with open(self.jsonfn, 'a') as f:
+                f.write(json.dumps(self.snapshot()) + '\n')
+        if self.promfn is not None:
+            tmpfn = self.promfn + '.tmp'
+            with open(tmpfn, 'w') as f:
+                f.write(self.prometheus_text())
+            os.rename(tmpfn, self.promfn)
+        self.lastwritetime = time.time()
+
+    def next_write_time(self):
+        return self.lastwritetime + self.interval
+
+    def write_if_due(self):
+        import time
+
+        if time.time() >= self.next_write_time():
+            self.write()
+
+
+class WorkQueue(object):
+    """
+    The arXiv IDs still to be queried, kept in a heap ordered on when each
+    may next be handed out.
+
+    `push` with ``retry=True`` (for an ID that was not found, or could not be
+    stored) holds the ID back for `retrywaittime` sec, doubling with each
+    retry, and drops it into `failed` once it has been retried `maxretries`
+    times.  Otherwise it is handed out again before anything else.
+
+    IDs handed out by `pop` are in-flight until `done` or `push` is called
+    for them.  `save` writes the queue (including the in-flight IDs, which
+    `load` makes ready to hand out again) so a run can be picked up where it
+    stopped.
+    """
+    def __init__(self, ids=(), maxretries=5, retrywaittime=600):
+        self.maxretries = maxretries
+        self.retrywaittime = retrywaittime
+
+        self.heap = []  # (time eligible, seq, arxivid)
+        self.queued = set()
+        self.inflight = set()
+        self.retries = {}  # arxivid -> # of retries so far
+        self.failed = {}  # arxivid -> why it was given up on
+        self.ndone = 0
+        self.seq = 0
+        self.frontseq = 0
+
+        for aid in ids:
+            if aid not in self.queued:
+                self.heap.append((0, self.seq, aid))
+                self.queued.add(aid)
+                self.seq += 1
+        # already a heap, as it is sorted
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __repr__(self):
+        return '<WorkQueue: {0} queued, {1} in-flight, {2} failed>'.format(len(self.heap), len(self.inflight), len(self.failed))
+
+    def pop(self, n=1):
+        """
+        Returns a list of up to `n` IDs that are ready to be handed out
+        """
+        import time
+        from heapq import heappop
+
+        now = time.time()
+        aids = []
+        while self.heap and len(aids) < n and self.heap[0][0] <= now:
+            aid = heappop(self.heap)[2]
+            self.queued.remove(aid)
+            self.inflight.add(aid)
+            aids.append(aid)
+        return aids
+
+    def push(self, aid, retry=False, reason=''):
+        """
+        Puts `aid` (an id or list of ids) back in the queue.  See the class
+        docstring for `retry`.  `reason` is recorded for IDs that fail.
+        """
+        import time
+        from heapq import heappush
+
+        aids = aid if isinstance(aid, list) else [aid]
+        if not retry:
+            aids = aids[::-1]  # so that they come back out in the same order
+
+        for aid in aids:
+            self.inflight.discard(aid)
+            if aid in self.queued or aid in self.failed:
+                continue
+
+            if retry:
+                nretries = self.retries.get(aid, 0) + 1
+                if nretries > self.maxretries:
+                    print 'Giving up on', aid, 'after', self.maxretries, 'retries'
+                    self.failed[aid] = reason
+                    self.retries.pop(aid, None)
+                    continue
+                self.retries[aid] = nretries
+                entry = (time.time() + self.retrywaittime * 2 ** (nretries - 1), self.seq, aid)
+                self.seq += 1
+            else:
+                self.frontseq -= 1
+                entry = (0, self.frontseq, aid)
+
+            heappush(self.heap, entry)
+            self.queued.add(aid)
+
+    def done(self, aids):
+        for aid in aids:
+            if aid in self.inflight:
+                self.inflight.remove(aid)
+                self.ndone += 1
+            self.retries.pop(aid, None)
+
+    def next_eligible_time(self):
+        """
+        When the next ID can be handed out, or None if the queue is empty
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def save(self, fn):
+        """
+        Pickles the queue to `fn`, replacing it atomically
+        """
+        import os
+        import cPickle
+
+        tmpfn = fn + '.tmp'
+        with open(tmpfn, 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfn, fn)
+
+    @classmethod
+    def load(cls, fn):
+        import cPickle
+
+        with open(fn, 'rb') as f:
+            wq = cPickle.load(f)
+        wq.push(sorted(wq.inflight))
+        return wq
+
 
 class ADSQuerier(object):
     def __init__(self, dbname='citestats', collname='astroph',
                  mirrorurls=mirrors, querywaittime=30, overwritedb=False,
                  mainloopsleeptime=1, statuslinewaittime=120,
-                 timeoutwaittime=120, timeoutlimit=5):
+                 timeoutwaittime=120, timeoutlimit=5, batchsize=1,
+                 persistentworkers=False, bufferwrites=False, flushcount=100,
+                 flushtime=30, adaptivewait=False, minwaittime=15,
+                 maxwaittime=600, scheduler='fifo', stragglerfactor=3,
+                 probeinterval=300, maxprobeinterval=3600, probetimeout=10,
+                 maxreopens=3, queuefn=None, queuesavetime=300, maxretries=5,
+                 retrywaittime=600, metricsfn=None, promfn=None,
+                 metricsinterval=60, profilefrac=0, profiledir=None):
+        """
+        If `batchsize` is >1, each mirror is handed up to that many IDs at a
+        time, which it gets in a single ``nph-abs_connect`` query.  ADS will not
+        return more than `maxadsbatch` (100) records per query, so a bigger
+        `batchsize` is a ValueError.
+
+        If `persistentworkers` is True, each mirror uses one long-lived worker
+        process for all its queries instead of a new process per query.
+
+        If `bufferwrites` is True, the results from all the mirrors are sent
+        back here and written in bulk with a `MongoWriteBuffer` (see there for
+        `flushcount` and `flushtime`).  This implies `persistentworkers`, as
+        the results come back over the workers' pipes.
+
+        If `adaptivewait` is True, each mirror's time between queries starts
+        at `querywaittime` and is then adjusted from how that mirror is doing
+        (see `ADSMirror.set_adaptive_wait`), staying between `minwaittime` and
+        `maxwaittime`.
+
+        `scheduler` sets how `main_loop` hands out IDs: 'fifo' gives the next
+        ID(s) to whichever mirror is ready, while 'latency' uses a
+        `LatencyScheduler` (with `stragglerfactor`) to favor faster mirrors
+        and re-do stuck queries at the end of the run.
+
+        A mirror that times out `timeoutlimit` times in a row, or hits any
+        other HTTP or network error than a 404, is taken out of service by its
+        `CircuitBreaker` and put back once it answers health probes again
+        (see there for `probeinterval`, `maxprobeinterval`, `probetimeout`
+        and `maxreopens`).  If `probeinterval` is None, such mirrors are
+        instead deactivated for the rest of the run, as are mirrors with any
+        other kind of error (e.g. a failed db write), which probing the mirror
+        would not fix.
+
+        The IDs still to query are kept in a `WorkQueue` (see there for
+        `maxretries` and `retrywaittime`).  If `queuefn` is given, the queue
+        is saved there every `queuesavetime` sec and at the end of a run, and
+        is loaded from there instead of the db if it exists, so a run that
+        died picks up where it stopped.  It is deleted once the queue is
+        drained, so the next run starts afresh from the db.
+
+        `main_loop` waits on the mirrors' result pipes, so it hands out the
+        next ID as soon as a mirror is done.  It only wakes up on its own for
+        the status line, saving the queue, flushing writes and held-back IDs,
+        or every `mainloopsleeptime` sec while it has something it needs to
+        check on (a latency scheduler or an open circuit).
+
+        If `metricsfn` or `promfn` are given, a `HarvestMetrics` is kept in
+        `metrics`, and written every `metricsinterval` sec as JSON lines to
+        `metricsfn` and/or a Prometheus textfile to `promfn`.
+
+        If `profiledir` is given, a random `profilefrac` of the queries are
+        run under `cProfile`, and at the end of a run the profiles are
+        combined into one file per mirror in `profiledir` (see
+        `aggregate_profiles`).
+        """
 
         self.dbname = dbname
         self.collname = collname
@@ -505,13 +2049,53 @@ class ADSQuerier(object):
         self.statuslinewaittime = statuslinewaittime
         self.timeoutwaittime = timeoutwaittime
         self.timeoutlimit = timeoutlimit
+        self.batchsize = batchsize
+        self.bufferwrites = bufferwrites
+        self.flushcount = flushcount
+        self.flushtime = flushtime
+        if batchsize > maxadsbatch:
+            raise ValueError('batchsize can be at most {0}, as that is all ADS returns per query'.format(maxadsbatch))
+        if scheduler not in ('fifo', 'latency'):
+            raise ValueError('invalid scheduler ' + str(scheduler))
+        self.scheduler = scheduler
+        self.stragglerfactor = stragglerfactor
+        self.queuefn = queuefn
+        self.queuesavetime = queuesavetime
+        self.maxretries = maxretries
+        self.retrywaittime = retrywaittime
+
+        if bufferwrites:
+            persistentworkers = True
 
         self.mirrors = []
         for m in mirrorurls:
             if isinstance(m, basestring):  # just URL
-                self.mirrors.append(ADSMirror(m))
+                self.mirrors.append(ADSMirror(m, persistent=persistentworkers))
             else:  # (name, URL) tuple
-                self.mirrors.append(ADSMirror(m[1], m[0]))
+                self.mirrors.append(ADSMirror(m[1], m[0], persistent=persistentworkers))
+        if adaptivewait:
+            for m in self.mirrors:
+                m.set_adaptive_wait(querywaittime, minwaittime, maxwaittime)
+        if probeinterval is not None:
+            for m in self.mirrors:
+                m.breaker = CircuitBreaker(m, probeinterval, maxprobeinterval, probetimeout, maxreopens)
+
+        self.profiledir = profiledir
+        for m in self.mirrors:
+            m.profilefrac = profilefrac
+            m.profiledir = profiledir
+
+        self.metrics = None
+        if metricsfn is not None or promfn is not None:
+            self.metrics = HarvestMetrics(metricsfn, promfn, metricsinterval)
+            for m in self.mirrors:
+                m.metrics = self.metrics
+
+    def mirror_waittime(self, m):
+        """
+        The time to wait between queries for mirror `m`
+        """
+        return self.querywaittime if m.waittime is None else m.waittime
 
     def get_arxiv_ids(self, overwrite=False):
         from pymongo import MongoClient
@@ -521,82 +2105,557 @@ class ADSQuerier(object):
             coll = conn[self.dbname][self.collname]
 
             if overwrite:
-                return [doc['arxiv_id'] for doc in coll.find()]
+                query = {}
             else:
-                return [doc['arxiv_id'] for doc in coll.find() if not 'bibcode' in doc]
+                # matches the documents with no bibcode, using its index
+                query = {'bibcode': None}
+            return [doc['arxiv_id'] for doc in coll.find(query, {'arxiv_id': 1, '_id': 0})]
 
         finally:
             conn.close()
 
+    def get_work_queue(self):
+        """
+        Returns the `WorkQueue` saved in `queuefn`, or a new one from the db
+        """
+        import os
+
+        if self.queuefn is not None and os.path.exists(self.queuefn):
+            workq = WorkQueue.load(self.queuefn)
+            print 'Resuming from', self.queuefn, '-', workq
+            return workq
+        return WorkQueue(self.get_arxiv_ids(self.overwritedb), self.maxretries, self.retrywaittime)
+
+    def save_work_queue(self, workq):
+        """
+        Saves `workq` to `queuefn`, or deletes `queuefn` if there is nothing
+        left in `workq` to query
+        """
+        import os
+
+        if self.queuefn is None:
+            return
+        if len(workq) > 0 or workq.inflight:
+            workq.save(self.queuefn)
+        elif os.path.exists(self.queuefn):
+            os.remove(self.queuefn)
+
+    def aggregate_profiles(self):
+        """
+        Combines the profiles so far (see `aggregate_profiles`), if profiling
+        """
+        import os
+
+        if self.profiledir is not None and os.path.isdir(self.profiledir):
+            allstats = aggregate_profiles(self.profiledir)
+            if allstats:
+                print 'Wrote profiles for', len(allstats), 'mirrors to', self.profiledir
+
+    def write_metrics(self, workq, force=False):
+        """
+        Writes out the metrics if it's time to (or regardless if `force`)
+        """
+        if self.metrics is not None:
+            self.metrics.set_progress(len(workq), len(workq.inflight), len(workq.failed), workq.ndone)
+            if force:
+                self.metrics.write()
+            else:
+                self.metrics.write_if_due()
+
     def main_loop(self, launchspread=0):
         import time
 
-        aidstoquery = self.get_arxiv_ids(self.overwritedb)
+        aidstoquery = self.get_work_queue()
+
+        ndonestart = aidstoquery.ndone
+        print '# of IDs to start with:', len(aidstoquery)
+
+        writebuffer = conn = None
+        if self.bufferwrites:
+            from pymongo import MongoClient
 
-        nstart = len(aidstoquery)
-        print '# of IDs to start with:', nstart
+            conn = MongoClient()
+            writebuffer = MongoWriteBuffer(conn[self.dbname][self.collname],
+                                           self.flushcount, self.flushtime)
+
+        scheduler = None
+        if self.scheduler == 'latency':
+            scheduler = LatencyScheduler(self, self.stragglerfactor)
+
+        try:
+            laststatustime = -float('inf')
+            lastsavetime = time.time()
+            sttime = time.time()
+            launched = False
+            while len(aidstoquery) > 0 or any([m.currarxivid is not None for m in self.mirrors]):
+                #check if each mirror is available, try to give a job, if not check for errors
+                allerrored = True
+                again = False  # if a mirror should get another look right away
+                for m in self.mirrors:
+                    if m.check_ready():
+                        allerrored = False
+                        if m.lastarxivid is not None:
+                            self._query_done(m, aidstoquery, m.missingids, scheduler, writebuffer)
+
+                        if len(aidstoquery) == 0:
+                            if scheduler is not None:
+                                straggler = scheduler.find_straggler(m, time.time())
+                                if straggler is not None:
+                                    print 'Re-doing', straggler.currarxivid, 'from straggling', straggler, 'on', m
+                                    aid = straggler.currarxivid
+                                    scheduler.speculate(aid if isinstance(aid, list) else [aid])
+                                    m.spawn_arxiv_proc(aid, self.dbname, self.collname, self.mirror_waittime(m),
+                                                       storeresults=writebuffer is None)
+                            continue
+                        if scheduler is not None and scheduler.should_defer(m, len(aidstoquery), time.time()):
+                            continue
+
+                        if not launched:
+                            time.sleep(launchspread)
+
+                        nbatch = self.batchsize
+                        if scheduler is not None and self.batchsize > 1:
+                            nbatch = scheduler.batch_size(m, self.batchsize)
+                        aid = aidstoquery.pop(nbatch)
+                        if len(aid) == 0:  # all held back for now
+                            continue
+                        if self.batchsize == 1:
+                            aid = aid[0]
+                        m.spawn_arxiv_proc(aid, self.dbname, self.collname, self.mirror_waittime(m),
+                                           storeresults=writebuffer is None)
+                    elif m.error is None:
+                        allerrored = False
+                    elif m.breaker is not None and m.breaker.state == 'halfopen' and m.currarxivid is None:
+                        # a failed trial still has its id, and goes on to be requeued below
+                        print 'Trying a query on', m, 'after its health probe'
+                        self._halfopen_mirror(m)
+                        allerrored = False
+                        again = True
+                    else:  # error is not None
+                        if not m.errornoted:
+                            aid = m.currarxivid
+                            m.currarxivid = None
+                            if self._query_failed(m, aidstoquery, aid, scheduler):
+                                allerrored = False
+                                again = True
+                        if m.breaker is not None and m.breaker.may_recover():
+                            allerrored = False  # it may yet come back
+                if allerrored:
+                    print 'All mirrors in error state!  Dropping out of main loop'
+                    return
+
+                launched = True
+
+                if writebuffer is not None and writebuffer.flush_due():
+                    self._flush_write_buffer(writebuffer, aidstoquery)
+
+                if (time.time() - laststatustime) >= self.statuslinewaittime:
+                    self._print_status(aidstoquery, sttime, ndonestart)
+                    laststatustime = time.time()
+
+                if (time.time() - lastsavetime) >= self.queuesavetime:
+                    self.save_work_queue(aidstoquery)
+                    lastsavetime = time.time()
+                self.write_metrics(aidstoquery)
+
+                if again:
+                    continue
+                if len(aidstoquery) == 0 and all([m.currarxivid is None for m in self.mirrors]):
+                    continue  # all done, so out of the loop without waiting
+                deadlines = [laststatustime + self.statuslinewaittime]
+                if self.queuefn is not None:
+                    deadlines.append(lastsavetime + self.queuesavetime)
+                if self.metrics is not None:
+                    deadlines.append(self.metrics.next_write_time())
+                if writebuffer is not None and len(writebuffer) > 0:
+                    deadlines.append(writebuffer.lastflushtime + writebuffer.flushtime)
+                nexteligible = aidstoquery.next_eligible_time()
+                if nexteligible > time.time() and any([m.currarxivid is None and m.error is None for m in self.mirrors]):
+                    deadlines.append(nexteligible)  # an idle mirror is waiting on held-back IDs
+                timeout = min(deadlines) - time.time()
+                if scheduler is not None or any([m.breaker is not None and m.breaker.may_recover() for m in self.mirrors]):
+                    timeout = min(timeout, self.mainloopsleeptime)
+                self._wait_for_results(timeout)
+
+        finally:
+            self._collect_finished(aidstoquery, writebuffer)
+            self.stop_workers()
+            self.stop_breakers()
+            try:
+                if writebuffer is not None:
+                    try:
+                        for m in self.mirrors:
+                            if m.results is not None:
+                                for aid, data in m.results.iteritems():
+                                    writebuffer.add(aid, data)
+                                m.results = None
+                        self._flush_write_buffer(writebuffer, aidstoquery)
+                    finally:
+                        conn.close()
+            finally:
+                self.save_work_queue(aidstoquery)
+                self.write_metrics(aidstoquery, True)
+                self.aggregate_profiles()
+                if aidstoquery.failed:
+                    print 'Gave up on', len(aidstoquery.failed), 'ids:', sorted(aidstoquery.failed)
+
+    def _print_status(self, workq, sttime, ndonestart):
+        """
+        Prints the status line for a run that started at `sttime` with
+        `ndonestart` IDs of `workq` done.  The time remaining is estimated from
+        the rate IDs have been done at since then, and is '?' until one is.
+        """
+        import time
 
-        laststatustime = -float('inf')
+        elapsedhr = (time.time() - sttime) / 3600.
+        ndone = workq.ndone - ndonestart
+        nleft = len(workq) + len(workq.inflight)
+        remhr = elapsedhr / ndone * nleft if ndone > 0 else '?'
+        msg = 'STATUS: {0} remaining IDs, {1} hr elapsed, ~{2} hr remaining.  {3} (of {4}) mirrors active.{5}'
+        print msg.format(len(workq), elapsedhr, remhr,
+                         sum([m.error is None for m in self.mirrors]),
+                         len(self.mirrors), self._circuit_status())
+
+    def _wait_for_results(self, timeout):
+        """
+        Waits until a mirror's query is done, or for `timeout` sec
+        """
+        import time
+        import errno
+        import select
+
+        timeout = max(timeout, 0)
+        handles = [m.result_handle() for m in self.mirrors if m.result_handle() is not None]
+        if len(handles) == 0:
+            time.sleep(timeout)
+            return
+        try:
+            select.select(handles, [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def _halfopen_mirror(self, m):
+        """
+        Puts a mirror whose circuit is half-open back in service so that it
+        gets a trial query.  It is set one timeout away from the limit, so a
+        failing trial opens the circuit again.
+        """
+        m.clear_error()
+        m.timeoutcount = self.timeoutlimit - 1
+
+    def _circuit_status(self):
+        """
+        The part of the status line listing mirrors whose circuit is not closed
+        """
+        notclosed = [m.breaker for m in self.mirrors if m.breaker is not None and m.breaker.state != 'closed']
+        if len(notclosed) == 0:
+            return ''
+        return '  Circuits: ' + ', '.join(['{0} {1}'.format(b.mirror.readablename, 'given up' if b.givenup else b.state)
+                                           for b in notclosed])
+
+    def _requeue(self, aidstoquery, aid, retry, scheduler=None, reason=''):
+        """
+        Puts `aid` (an id or list of ids) back in the `WorkQueue`
+        `aidstoquery` (see `WorkQueue.push` for `retry` and `reason`).  Ids
+        another mirror has already done are left out.
+        """
+        aids = aid if isinstance(aid, list) else [aid]
+        if scheduler is not None:
+            aidstoquery.done([aid for aid in aids if aid in scheduler.doneids])
+            aids = scheduler.not_done(aids)
+        aidstoquery.push(aids, retry, reason)
+
+    def _complete_speculated(self, m, scheduler):
+        """
+        Deals with `m` having just finished its query when using a
+        `LatencyScheduler`: drops results another mirror already got, and
+        cancels other mirrors still working on queries that are now done.
+        """
+        aids = m.lastarxivid if isinstance(m.lastarxivid, list) else [m.lastarxivid]
+        newids = scheduler.complete(aids)
+        if m.results is not None and len(newids) < len(aids):
+            m.results = dict([(aid, m.results[aid]) for aid in newids if aid in m.results])
+
+        for mi in self.mirrors:
+            if mi is not m and scheduler.finished_elsewhere(mi):
+                print 'Cancelling duplicate query on', mi
+                mi.terminate_proc()
+                mi.currarxivid = None
+
+    def _collect_finished(self, aidstoquery, writebuffer):
+        """
+        Picks up the results of any queries that have finished but not been
+        checked yet, so they are not lost when the workers are stopped.
+        """
+        for m in self.mirrors:
+            if m.currarxivid is None or not m.check_ready():
+                continue
+            self._query_done(m, aidstoquery, m.missingids, writebuffer=writebuffer)
+
+    def _query_done(self, m, aidstoquery, missing, scheduler=None, writebuffer=None):
+        """
+        Deals with `m` having just finished its query of `m.lastarxivid`
+        without error, `missing` being the ids ADS did not find.  Those go back
+        in the `WorkQueue` `aidstoquery`, the rest are done - or, with a
+        `writebuffer`, their results go in it and they are done once written.
+        Used by both `main_loop` and `threaded_loop`.
+        """
+        aids = m.lastarxivid if isinstance(m.lastarxivid, list) else [m.lastarxivid]
+        if missing:
+            print 'Could not locate', len(missing), 'ids in', m, 'sending to end of queue'
+            self._requeue(aidstoquery, missing, True, scheduler, 'not found')
+        if scheduler is not None:
+            self._complete_speculated(m, scheduler)
+        if writebuffer is None:
+            aidstoquery.done([aid for aid in aids if aid not in missing])
+        elif m.results is not None:
+            for aid, data in m.results.iteritems():
+                writebuffer.add(aid, data)
+        m.results = None
+        m.missingids = []
+        m.lastarxivid = None
+
+    def _query_failed(self, m, aidstoquery, aid, scheduler=None):
+        """
+        Deals with the error `m` just got querying `aid` (an id, a list of
+        them, or None).  A 404 or a timeout within `timeoutlimit` sends the
+        ids back to the `WorkQueue` `aidstoquery` and clears the error.
+        Anything else is reported, and trips `m`'s circuit breaker if the
+        mirror itself is at fault.  Used by both `main_loop` and
+        `threaded_loop`.
+
+        Returns True if `m` can go on querying, False if it is out of service.
+        """
+        import time
+
+        if aid is not None and m.http_error_code() == 404:
+            print 'Could not locate id', aid, 'in', m, 'sending to end of queue'
+            self._requeue(aidstoquery, aid, True, scheduler, 'HTTP Error 404')
+            m.clear_error()
+            return True
+
+        if aid is not None:
+            self._requeue(aidstoquery, aid, False, scheduler)
+
+        if m.timed_out():
+            if m.timeoutcount < self.timeoutlimit:
+                print 'Resetting timeout error on ' + str(m) + ', waiting', self.timeoutwaittime, 'sec. Will allow', self.timeoutlimit - m.timeoutcount, 'more timeouts.'
+                m.clear_error()
+                # this tricks the mirror into thinking it has to wait `timeoutwaittime` from now
+                m.prevqtime = time.time() + self.timeoutwaittime - self.mirror_waittime(m)
+                return True
+            if m.breaker is None:
+                print 'Timed out', self.timeoutlimit, 'times - DEACTIVATING', m
+            else:
+                print 'Timed out', self.timeoutlimit, 'times -', m, 'out of service'
+        else:
+            print 'Error for mirror', m
+            print 'Error name:', m.error[0]
+            print 'Error object:', m.error[1]
+            print 'Error tb:', m.error[2]
+        m.errornoted = True
+
+        if m.breaker is not None:
+            if m.network_error():
+                m.breaker.trip()
+            else:  # not something a working mirror fixes
+                m.breaker.reset()
+        return False
+
+    def _flush_write_buffer(self, writebuffer, aidstoquery):
+        """
+        Flushes `writebuffer`, reporting any failed documents and sending
+        their ids back to the `WorkQueue` `aidstoquery`
+        """
+        import time
+
+        aids = [aid for aid, data in writebuffer.pending]
         sttime = time.time()
-        launched = False
-        while len(aidstoquery) > 0 and any([m.currarxivid is not None for m in self.mirrors]):
-            #check if each mirror is available, try to give a job, if not check for errors
-            allerrored = True
+        failures = writebuffer.flush()
+        if self.metrics is not None and len(aids) > 0:
+            self.metrics.record_stage('write buffer', 'store', time.time() - sttime)
+        for aid, errmsg in failures:
+            print 'Failed to write', aid, 'to the db:', errmsg
+            aidstoquery.push(aid, True, errmsg)
+        failedaids = set([aid for aid, errmsg in failures])
+        aidstoquery.done([aid for aid in aids if aid not in failedaids])
+        return len(aids) - len(failures)
+
+    def threaded_loop(self, queuesize=100):
+        """
+        An alternative to `main_loop` that drives all the mirrors concurrently
+        from threads in this process rather than polling subprocesses.  Each
+        mirror has its own `RateLimiter` for `querywaittime`, and the IDs are
+        fed to the mirrors through a queue holding at most `queuesize` of them.
+
+        Timeouts, 404s and failing mirrors are handled the same way as in
+        `main_loop`.
+        """
+        import time
+        import threading
+        from pymongo import MongoClient
+
+        aidstoquery = self.get_work_queue()
+
+        ndonestart = aidstoquery.ndone
+        print '# of IDs to start with:', len(aidstoquery)
+
+        state = {'aids': aidstoquery,
+                 'lock': threading.Lock(),
+                 'idqueue': queue.Queue(queuesize),
+                 'ninflight': 0,
+                 'done': threading.Event()}
+
+        def feeder():
+            while not state['done'].is_set():
+                with state['lock']:
+                    aid = state['aids'].pop()
+                    aid = aid[0] if aid else None
+                    if aid is not None:
+                        state['ninflight'] += 1
+                if aid is None:
+                    time.sleep(self.mainloopsleeptime)
+                    continue
+                while not state['done'].is_set():
+                    try:
+                        state['idqueue'].put(aid, timeout=self.mainloopsleeptime)
+                        break
+                    except queue.Full:
+                        pass
+
+        client = MongoClient()
+        try:
+            coll = client[self.dbname][self.collname]
+
+            threads = [threading.Thread(target=feeder)]
             for m in self.mirrors:
-                if m.check_ready():
-                    if not launched:
-                        time.sleep(launchspread)
-
-                    aid = aidstoquery.pop()
-                    m.spawn_arxiv_proc(aid, self.dbname, self.collname, self.querywaittime)
-                    allerrored = False
-                elif m.error is None:
-                    allerrored = False
-                elif 'HTTP Error 404' in m.error[1] and m.currarxivid is not None:  # error is not None
-                    print 'Could not locate id', m.currarxivid, 'in', m, 'sending to end of queue'
-                    aidstoquery.insert(0, m.currarxivid)
-                    m.currarxivid = None
-                    m.clear_error()
-                else:  # error is not None
-
-                    if m.currarxivid is not None:
-                        aidstoquery.append(m.currarxivid)
-                        m.currarxivid = None
-
-                    if m.timed_out():
-                        if m.timeoutcount < self.timeoutlimit:
-                            print 'Resetting timeout error on ' + str(m) + ', waiting', self.timeoutwaittime, 'sec. Will allow', self.timeoutlimit - m.timeoutcount, 'more timeouts.'
-                            m.errornoted = True
-                            m.clear_error()
-                            # this tricks the mirror into thinking it has to wait `timeoutwaittime` from now
-                            m.prevqtime = time.time() + self.timeoutwaittime - self.querywaittime
-                        elif m.timeoutcount == self.timeoutlimit:
-                            print 'Timed out', self.timeoutlimit, 'times - DEACTIVATING', m
-                            m.errornoted = True
-                            m.timeoutcount += 1  # silences future visits
-                    elif not m.errornoted:
-                        print 'Error for mirror', m
-                        print 'Error name:', m.error[0]
-                        print 'Error object:', m.error[1]
-                        print 'Error tb:', m.error[2]
-                        m.errornoted = True
-            if allerrored:
-                print 'All mirrors in error state!  Dropping out of main loop'
-                return
+                threads.append(threading.Thread(target=self._mirror_thread, args=(m, coll, state)))
+            for t in threads:
+                t.daemon = True
+                t.start()
+
+            sttime = time.time()
+            laststatustime = -float('inf')
+            lastsavetime = time.time()
+            while True:
+                with state['lock']:
+                    nremaining = len(state['aids'])
+                    finished = nremaining == 0 and state['ninflight'] == 0
+                if finished:
+                    break
+                if not any([t.is_alive() for t in threads[1:]]):
+                    print 'All mirrors in error state!  Dropping out of main loop'
+                    break
 
-            launched = True
+                if (time.time() - laststatustime) >= self.statuslinewaittime:
+                    with state['lock']:
+                        self._print_status(aidstoquery, sttime, ndonestart)
+                    laststatustime = time.time()
 
-            if (time.time() - laststatustime) >= self.statuslinewaittime:
-                elapsedhr = (time.time() - sttime) / 3600.
-                hrperquery = elapsedhr / (nstart - len(aidstoquery))
-                remhr = hrperquery * len(aidstoquery)
-                msg = 'STATUS: {0} remaining IDs, {1} hr elapsed, ~{2} hr remaining.  {3} (of {4}) mirrors active.'
-                print msg.format(len(aidstoquery), elapsedhr, remhr,
-                                 sum([m.error is None for m in self.mirrors]),
-                                 len(self.mirrors))
-                laststatustime = time.time()
+                if (time.time() - lastsavetime) >= self.queuesavetime:
+                    with state['lock']:
+                        self.save_work_queue(aidstoquery)
+                    lastsavetime = time.time()
+                with state['lock']:
+                    self.write_metrics(aidstoquery)
 
-            time.sleep(self.mainloopsleeptime)
+                time.sleep(self.mainloopsleeptime)
+        finally:
+            state['done'].set()
+            self.stop_breakers()
+            for t in threads:
+                t.join()
+            client.close()
+            self.save_work_queue(aidstoquery)
+            self.write_metrics(aidstoquery, True)
+            self.aggregate_profiles()
+            if aidstoquery.failed:
+                print 'Gave up on', len(aidstoquery.failed), 'ids:', sorted(aidstoquery.failed)
+
+    def _mirror_thread(self, m, coll, state):
+        """
+        The per-mirror part of `threaded_loop`
+        """
+        import time
+        import cProfile
+        import traceback
+
+        limiter = RateLimiter(self.mirror_waittime(m), m.prevqtime)
+        while not state['done'].is_set():
+            try:
+                aids = [state['idqueue'].get(timeout=self.mainloopsleeptime)]
+            except queue.Empty:
+                continue
+            while len(aids) < self.batchsize:
+                try:
+                    aids.append(state['idqueue'].get_nowait())
+                except queue.Empty:
+                    break
+            m.currarxivid = aids if self.batchsize > 1 else aids[0]
+
+            waitstarttime = time.time()
+            if not ads_query_cached(m.currarxivid, m.url):
+                limiter.wait()
+            qstarttime = time.time()
+            stagetimes = {'wait': qstarttime - waitstarttime}
+
+            # cProfile only sees this thread, so the other mirrors stay out of it
+            profilefn = m.next_profile_fn()
+            if profilefn is not None:
+                prof = cProfile.Profile()
+                prof.enable()
+            error = None
+            try:
+                if self.batchsize > 1:
+                    datas = get_cite_count_data_from_ads_batch(aids, m.url, timings=stagetimes)
+                else:
+                    datas = {aids[0]: get_cite_count_data_from_ads(aids[0], m.url, timings=stagetimes)}
+                storestarttime = time.time()
+                for aid, data in datas.iteritems():
+                    coll.update({'arxiv_id': aid}, ads_data_update(data))
+                stagetimes['store'] = time.time() - storestarttime
+            except Exception as e:
+                error = ('error while getting ' + ', '.join(aids), e, traceback.format_exc())
+            finally:
+                if profilefn is not None:
+                    prof.disable()
+                    _dump_profile(prof, profilefn)
+            m.prevqtime = limiter.lasttime
+
+            with state['lock']:
+                state['ninflight'] -= len(aids)
+                m.currarxivid = None
+                if error is None:
+                    missing = [aid for aid in aids if aid not in datas]
+                    m.record_success(time.time() - qstarttime, stagetimes, len(missing))
+                    m.lastarxivid = aids
+                    self._query_done(m, state['aids'], missing)
+                    carryon = True
+                else:
+                    m.record_error(error)
+                    carryon = self._query_failed(m, state['aids'], aids)
+                limiter.interval = self.mirror_waittime(m)
+                limiter.lasttime = m.prevqtime
+                if carryon:
+                    continue
+                if m.breaker is None or not m.breaker.may_recover():
+                    return
+
+            # wait out the open circuit, then try again
+            while m.breaker.state == 'open' and not state['done'].is_set():
+                time.sleep(self.mainloopsleeptime)
+            if m.breaker.state == 'halfopen':
+                with state['lock']:
+                    print 'Trying a query on', m, 'after its health probe'
+                    self._halfopen_mirror(m)
+
+    def stop_workers(self):
+        """
+        Shuts down the persistent worker processes, if there are any
+        """
+        for m in self.mirrors:
+            m.stop_worker()
 
     def clear_keyboard_interrupts(self):
         for m in self.mirrors:
@@ -605,11 +2664,21 @@ class ADSQuerier(object):
                 if isinstance(m.error[1], KeyboardInterrupt):
                     m.clear_error()
 
+    def stop_breakers(self):
+        """
+        Stops the circuit breakers' health probes, if any are running
+        """
+        for m in self.mirrors:
+            if m.breaker is not None:
+                m.breaker.stop()
+
     def clear_all_errors(self):
         for m in self.mirrors:
             m.check_ready()
             m.clear_error()
             m.timeoutcount = 0
+            if m.breaker is not None:
+                m.breaker.reset()
 
     def mirror_time_stats(self):
         d = {}
@@ -617,11 +2686,18 @@ class ADSQuerier(object):
             d[m.readablename] = m.time_stats()[:2]
         return d
 
+    def mirror_stage_stats(self):
+        d = {}
+        for m in self.mirrors:
+            d[m.readablename] = m.stage_stats()
+        return d
+
 
 # Analysis stuff
 #----------------
 
-def get_citecount_arrays(dbname='citestats', collname='astroph'):
+def get_citecount_arrays(dbname='citestats', collname='astroph', snapshot=None, maxage=86400,
+                         verifysnapshot=False):
     """
     Gets arrays for the interesting elements.  Returns a dictionary with
     * 'ids': arxiv ID
@@ -631,57 +2707,63 @@ def get_citecount_arrays(dbname='citestats', collname='astroph'):
     * 'postwd': the weekday number for the day the article appears on astro-ph (0 monday, 4 friday)
     * 'subyr': the year cooresponding to 'subdate'
 
+    If `snapshot` is given, it's a directory with a `citesnapshot` of the
+    collection, and the arrays are memory-mapped from there.  The snapshot
+    is re-written from the db first if it is stale (see
+    `citesnapshot.snapshot_is_stale` for `maxage`, and `verifysnapshot`,
+    which is its `verify`).
+    """
+    import citesnapshot
+
+    if snapshot is not None:
+        if citesnapshot.snapshot_is_stale(snapshot, dbname, collname, maxage, verifysnapshot):
+            print 'Snapshot', snapshot, 'is stale, re-writing it from', dbname + '.' + collname
+            citesnapshot.write_snapshot(snapshot, dbname, collname)
+        cols = citesnapshot.load_snapshot(snapshot)
+
+        ids = cols['ids']
+        ncite = cols['ncites']
+        subdays = cols['subday']
+        subwd = cols['subwd']
+        postwd = cols['postwd']
+        subyr = cols['subyr']
+    else:
+        ids, ncite, arxivdates = _citecount_columns_from_db(dbname, collname)
+        subdays, subwd, postwd, subyr = citesnapshot.submission_columns(arxivdates)
+    subdate = subdays.astype(object)
+
+    return dict([(nm, locals()[nm]) for nm in 'ids,ncite,subdate,subwd,postwd,subyr'.split(',')])
+
+
+def _citecount_columns_from_db(dbname, collname):
+    """
+    The arxiv IDs, citation counts and arxiv dates of the papers with
+    citations, straight from the db
     """
-    import datetime
-    import pytz
     from pymongo import MongoClient
 
     conn = MongoClient()
     try:
         coll = conn[dbname][collname]
 
-        cur = coll.find({'ncites':{'$exists' : True}})
+        cur = coll.find({'ncites':{'$exists' : True}},
+                        {'arxiv_id': 1, 'ncites': 1, 'arxiv_date': 1, '_id': 0})
         print 'Found', cur.count(), 'w/cites out of a total of', coll.find().count()
 
         #populate arrays using lists
         ids = []
         ncites = []
-        subdates = []
-        subwds = []
-        postwd = []
-        subyrs = []
-
-        ddt = datetime.timedelta(hours=16)
-        est = pytz.timezone('US/Eastern')
+        arxivdates = []
 
         for d in cur:
             ncites.append(d['ncites'])
             ids.append(d['arxiv_id'])
-
-            date = (pytz.utc.localize(d['arxiv_date']) - ddt).astimezone(est).date()
-
-            subdates.append(date)
-            subwds.append(date.weekday())
-            postwd.append(date.weekday())
-            subyrs.append(date.year)
+            arxivdates.append(d['arxiv_date'])
 
     finally:
         conn.close()
 
-    ids = np.array(ids)
-    ncite = np.array(ncites)
-    subdate = np.array(subdates)
-    subwd = np.array(subwds)
-    subyr = np.array(subyrs)
-
-
-    postwd = subwd.copy()
-    #Sat and Sun -> appear like things posted friday
-    postwd[postwd > 4] = 4
-    postwd += 2
-    postwd = postwd % 5
-
-    return dict([(nm, locals()[nm]) for nm in 'ids,ncite,subdate,subwd,postwd,subyr'.split(',')])
+    return np.array(ids), np.array(ncites), arxivdates
 
 
 
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+from __future__ import division
+
+"""
+A columnar on-disk snapshot of the analysis columns in the citestats db, so
+that analysis sessions can memory-map them instead of walking the whole
+collection.
+
+A snapshot is a directory with one ``.npy`` file per column and a
+``meta.json`` that says where it came from and when.  `snapdir` itself is a
+symlink to the current version (``<snapdir>.<created time>``), which is
+swapped atomically when a new one is written.  The columns are:
+
+* 'ids': arxiv ID
+* 'ncites': number of citations
+* 'arxiv_date': the arxiv date (UTC) as datetime64[us]
+* 'subday': the day the article was *submitted* (see `get_citecount_arrays`)
+  as datetime64[D]
+* 'subwd', 'postwd', 'subyr': as in `arxivcite.get_citecount_arrays`
+* 'bibcode': the ADS bibcode, or '' if there isn't one
+* 'onlyarxiv': True if ADS only has it as an arxiv eprint
+* 'injournal': True if ADS has a journal for it that isn't the arxiv
+
+Run as ``python citesnapshot.py [snapdir [dbname [collname]]]`` to (re)write
+one.
+"""
+import numpy as np
+
+columns = ('ids', 'ncites', 'arxiv_date', 'subday', 'subwd', 'postwd',
+           'subyr', 'bibcode', 'onlyarxiv', 'injournal')
+
+
+def submission_columns(arxivdates):
+    """
+    Derives the submission day/weekday/year columns from `arxivdates` (UTC,
+    a sequence of datetimes or a datetime64 array).  Returns
+    ``(subday, subwd, postwd, subyr)``.
+    """
+    import datevec
+
+    #anything after 4pm counts as the next day, so shift back 16 hours
+    ddt = np.timedelta64(16, 'h')
+    subday = datevec.days(datevec.utc_to_eastern(np.asarray(arxivdates, dtype='datetime64[us]') - ddt))
+    subwd = datevec.weekday(subday)
+    subyr = datevec.year(subday)
+
+    postwd = subwd.copy()
+    #Sat and Sun -> appear like things posted friday
+    postwd[postwd > 4] = 4
+    postwd += 2
+    postwd = postwd % 5
+
+    return subday, subwd, postwd, subyr
+
+
+def _coll_state(coll):
+    """
+    The cheap markers of what is in `coll`: the number of papers with
+    (``ncited``) and without (``ntotal``) citations, and when the latest
+    citation count was written (``ncites_updated``, see
+    `arxivcite.ads_data_update`).
+    """
+    cur = coll.find({'ncites_updated': {'$exists': True}}, {'ncites_updated': 1, '_id': 0})
+    latest = list(cur.sort('ncites_updated', -1).limit(1))
+    return {'ncited': coll.find({'ncites': {'$exists': True}}).count(),
+            'ntotal': coll.count(),
+            'ncites_updated': latest[0]['ncites_updated'].isoformat() if latest else None}
+
+
+def ncites_hash(ids, ncites):
+    """
+    A sha1 hash of the citation counts `ncites` of the papers `ids` (in that
+    order), for telling if any have changed
+    """
+    import hashlib
+
+    sha1 = hashlib.sha1()
+    for aid, n in zip(ids, ncites):
+        sha1.update(u'{0} {1}\n'.format(aid, n).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def _coll_ncites_hash(coll):
+    cur = coll.find({'ncites': {'$exists': True}}, {'arxiv_id': 1, 'ncites': 1, '_id': 0})
+    ids = []
+    ncites = []
+    for d in cur.sort('arxiv_id', 1):
+        ids.append(d['arxiv_id'])
+        ncites.append(d['ncites'])
+    return ncites_hash(ids, ncites)
+
+
+def write_snapshot(snapdir='citesnapshot', dbname='citestats', collname='astroph'):
+    """
+    Writes a snapshot of the papers in `dbname`.`collname` that have
+    citations to `snapdir`, replacing any snapshot already there.  The new
+    version is written to its own directory and the `snapdir` symlink is
+    then atomically replaced to point at it, so readers always see either
+    the old or the new snapshot in full.  The previous version is kept (for
+    anything still loading it) and older ones are removed.
+
+    Returns the snapshot metadata.
+    """
+    import os
+    import json
+    import time
+    import shutil
+    from pymongo import MongoClient
+
+    conn = MongoClient()
+    try:
+        coll = conn[dbname][collname]
+
+        meta = {'dbname': dbname, 'collname': collname, 'created': time.time()}
+        # counted before the scan, so anything written during it makes the
+        # snapshot look stale rather than up-to-date
+        meta.update(_coll_state(coll))
+
+        cur = coll.find({'ncites': {'$exists': True}},
+                        {'arxiv_id': 1, 'ncites': 1, 'arxiv_date': 1,
+                         'bibcode': 1, 'journal': 1, 'onlyarxiv': 1, '_id': 0})
+        # in a fixed order, for `ncites_hash`
+        cur = cur.sort('arxiv_id', 1)
+        ids = []
+        ncites = []
+        arxivdates = []
+        bibcodes = []
+        onlyarxiv = []
+        injournal = []
+        for d in cur:
+            ids.append(d['arxiv_id'])
+            ncites.append(d['ncites'])
+            arxivdates.append(d['arxiv_date'])
+            bibcodes.append(d.get('bibcode') or u'')
+            onlyarxiv.append(d.get('onlyarxiv', False))
+            injournal.append(d.get('journal') is not None and not d.get('onlyarxiv', False))
+    finally:
+        conn.close()
+
+    cols = {'ids': np.array(ids),
+            'ncites': np.array(ncites, dtype=int),
+            'arxiv_date': np.array(arxivdates, dtype='datetime64[us]'),
+            'bibcode': np.array(bibcodes, dtype=np.unicode_),
+            'onlyarxiv': np.array(onlyarxiv, dtype=bool),
+            'injournal': np.array(injournal, dtype=bool)}
+    cols['subday'], cols['subwd'], cols['postwd'], cols['subyr'] = submission_columns(cols['arxiv_date'])
+
+    meta['nrows'] = len(ids)
+    meta['columns'] = dict([(nm, cols[nm].dtype.str) for nm in columns])
+    meta['ncites_sha1'] = ncites_hash(ids, ncites)
+
+    snapdir = snapdir.rstrip(os.sep)
+    versiondir = '{0}.{1:.6f}'.format(snapdir, meta['created'])
+    tmpdir = versiondir + '.tmp'
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for nm in columns:
+        np.save(os.path.join(tmpdir, nm + '.npy'), cols[nm])
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.rename(tmpdir, versiondir)
+
+    prevdir = os.path.realpath(snapdir) if os.path.islink(snapdir) else None
+    if os.path.isdir(snapdir) and prevdir is None:
+        # a snapshot from before they were versioned - the one time there is
+        # no snapshot for a moment
+        prevdir = '{0}.{1:.6f}'.format(snapdir, os.path.getmtime(snapdir))
+        os.rename(snapdir, prevdir)
+
+    linkfn = snapdir + '.link.tmp'
+    if os.path.lexists(linkfn):
+        os.remove(linkfn)
+    os.symlink(os.path.basename(versiondir), linkfn)
+    os.rename(linkfn, snapdir)
+
+    # anything that has an old one memory-mapped keeps working, as the files
+    # are only unlinked
+    keep = set([os.path.realpath(versiondir)])
+    if prevdir is not None:
+        keep.add(os.path.realpath(prevdir))
+    for dirnm in _version_dirs(snapdir):
+        if os.path.realpath(dirnm) not in keep:
+            shutil.rmtree(dirnm)
+
+    return meta
+
+
+def _version_dirs(snapdir):
+    """
+    The versions of the snapshot `snapdir` on disk
+    """
+    import os
+    import re
+
+    parent, base = os.path.split(snapdir)
+    pattern = re.compile(re.escape(base) + r'\.\d+\.\d+$')
+    return [os.path.join(parent, fn) for fn in os.listdir(parent or '.')
+            if pattern.match(fn) and os.path.isdir(os.path.join(parent, fn))]
+
+
+def read_meta(snapdir):
+    """
+    The metadata for the snapshot in `snapdir`, or None if there isn't one
+    """
+    import os
+    import json
+
+    fn = os.path.join(snapdir, 'meta.json')
+    if not os.path.exists(fn):
+        return None
+    with open(fn) as f:
+        return json.load(f)
+
+
+def load_snapshot(snapdir='citesnapshot'):
+    """
+    Memory-maps the columns of the snapshot in `snapdir`.  Returns a
+    dictionary of the columns (see the module docstring) plus 'meta'.  The
+    `snapdir` symlink is only followed once, so everything comes from the
+    same version even if a new one is swapped in meanwhile.
+
+    The arrays are copy-on-write, so changing them doesn't touch the
+    snapshot.
+    """
+    import os
+
+    snapdir = os.path.realpath(snapdir)
+    meta = read_meta(snapdir)
+    if meta is None:
+        raise IOError('No snapshot in ' + snapdir)
+
+    # empty files can't be mapped
+    mmapmode = 'c' if meta['nrows'] > 0 else None
+    cols = dict([(nm, np.load(os.path.join(snapdir, nm + '.npy'), mmap_mode=mmapmode))
+                 for nm in meta['columns']])
+    cols['meta'] = meta
+    return cols
+
+
+def snapshot_is_stale(snapdir='citesnapshot', dbname='citestats',
+                      collname='astroph', maxage=86400, verify=False):
+    """
+    True if there is no snapshot in `snapdir`, or if it isn't of
+    `dbname`.`collname`, is more than `maxage` sec old (never, if None), or
+    the number of papers (with and without citations) or the time of the
+    latest citation count update have changed since it was taken.  These
+    take a few indexed queries.
+
+    If `verify` is True, the citation counts themselves are also compared by
+    hash (see `ncites_hash`), which means reading them all from the db.
+    """
+    import time
+    from pymongo import MongoClient
+
+    meta = read_meta(snapdir)
+    if meta is None:
+        return True
+    if meta['dbname'] != dbname or meta['collname'] != collname:
+        return True
+    if maxage is not None and time.time() - meta['created'] > maxage:
+        return True
+
+    conn = MongoClient()
+    try:
+        coll = conn[dbname][collname]
+        state = _coll_state(coll)
+        if any([meta.get(k) != v for k, v in state.iteritems()]):
+            return True
+        return verify and meta.get('ncites_sha1') != _coll_ncites_hash(coll)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+
+    meta = write_snapshot(*sys.argv[1:4])
+    print 'Wrote', meta['nrows'], 'papers from', meta['dbname'] + '.' + meta['collname']
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+from __future__ import division
+
+"""
+Vectorized UTC -> US/Eastern conversion and calendar fields for the
+analysis arrays.  These give the same answers as localizing each datetime
+with pytz, but work on whole ``datetime64`` arrays at once using the DST
+transition table pytz already has for 'US/Eastern'.
+"""
+import numpy as np
+
+# 0001-01-01 is ordinal 1, so 1970-01-01 (day 0 of datetime64) is this one
+_epochordinal = 719163
+
+_eastern = None
+
+
+def eastern_table():
+    """
+    The DST transition table for US/Eastern, as ``(transitions, offsets)``.
+    `transitions` are the UTC times each offset starts at (datetime64[s]) and
+    `offsets` the UTC offset (timedelta64[s]) in effect from then on.  Built
+    once from pytz and cached.
+    """
+    global _eastern
+
+    if _eastern is None:
+        import pytz
+
+        tz = pytz.timezone('US/Eastern')
+        transitions = np.array(tz._utc_transition_times, dtype='datetime64[s]')
+        offsets = [info[0].days * 86400 + info[0].seconds for info in tz._transition_info]
+        _eastern = transitions, np.array(offsets, dtype='timedelta64[s]')
+    return _eastern
+
+
+def utc_to_eastern(utc):
+    """
+    Converts `utc`, an array (or sequence) of naive UTC datetimes, to naive
+    US/Eastern local times as a datetime64[us] array.  NaT stays NaT.
+    """
+    transitions, offsets = eastern_table()
+    utc = np.asarray(utc, dtype='datetime64[us]')
+    # same lookup as pytz's fromutc - the last transition at or before `utc`
+    idx = np.searchsorted(transitions, utc, side='right') - 1
+    return utc + offsets[np.clip(idx, 0, offsets.size - 1)]
+
+
+def parse_arxiv_dates(dstrs):
+    """
+    Parses arxiv 'YYYY-MM-DDTHH:MM:SSZ' date strings (UTC) into a
+    datetime64[us] array.  None becomes NaT.
+    """
+    return np.array([('NaT' if d is None else d.rstrip('Z')) for d in dstrs],
+                    dtype='datetime64[us]')
+
+
+def days(dts):
+    """
+    The day each of the datetime64 `dts` falls on, as datetime64[D]
+    """
+    return np.asarray(dts).astype('datetime64[D]')
+
+
+def weekday(dts):
+    """
+    Weekday of each of `dts` - 0 is Monday, 6 is Sunday (like
+    `datetime.date.weekday`)
+    """
+    # 1970-01-01 was a Thursday
+    return (days(dts).astype(np.int64) + 3) % 7
+
+
+def hour(dts):
+    """
+    Hour of the day of each of `dts`
+    """
+    return np.asarray(dts).astype('datetime64[h]').astype(np.int64) % 24
+
+
+def year(dts):
+    """
+    Calendar year of each of `dts`
+    """
+    return np.asarray(dts).astype('datetime64[Y]').astype(int) + 1970
+
+
+def ordinal(dts):
+    """
+    Proleptic Gregorian ordinal of the day of each of `dts` (like
+    `datetime.date.toordinal`)
+    """
+    return days(dts).astype(np.int64) + _epochordinal
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+from __future__ import division
+
+"""
+Pooled keep-alive HTTP connections for the ADS and arXiv queries, so that
+repeated queries to the same mirror don't each pay for DNS and a TCP
+handshake, an optional on-disk cache of the responses, and a rate limiter
+for spacing out queries.
+"""
+import os
+import time
+import socket
+import httplib
+import threading
+from StringIO import StringIO
+from urlparse import urlsplit, urljoin
+from urllib2 import HTTPError
+
+#these are used for pools created by `get_pool` - see `configure_pools`
+poolsize = 2
+poolidletimeout = 60
+maxredirects = 5
+
+_pools = {}
+_poolspid = None
+_poolslock = threading.Lock()
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps up to `maxsize` idle keep-alive connections to a single host.
+    Connections that have been idle for more than `idletimeout` sec are closed
+    instead of being reused.
+    """
+    def __init__(self, scheme, host, maxsize=2, idletimeout=60):
+        self.scheme = scheme
+        self.host = host
+        self.maxsize = maxsize
+        self.idletimeout = idletimeout
+
+        self.idle = []  # (time put back, connection) pairs
+        self.lock = threading.Lock()
+
+        self.nnew = 0
+        self.nreused = 0
+
+    def __repr__(self):
+        return '<HTTPConnectionPool: "{0}://{1}" ({2} idle)>'.format(self.scheme, self.host, len(self.idle))
+
+    def evict_idle(self):
+        """
+        Closes the connections that have been idle too long
+        """
+        cutoff = time.time() - self.idletimeout
+        with self.lock:
+            keep = []
+            for t, conn in self.idle:
+                if t < cutoff:
+                    conn.close()
+                else:
+                    keep.append((t, conn))
+            self.idle = keep
+
+    def get_conn(self, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """
+        Returns ``(conn, reused)`` - an idle connection if there is one, or a
+        new one.
+        """
+        self.evict_idle()
+        with self.lock:
+            conn = self.idle.pop()[1] if self.idle else None
+
+        if conn is None:
+            if self.scheme == 'https':
+                conn = httplib.HTTPSConnection(self.host, timeout=timeout)
+            else:
+                conn = httplib.HTTPConnection(self.host, timeout=timeout)
+            self.nnew += 1
+            return conn, False
+        else:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.sock.settimeout(socket.getdefaulttimeout())
+                else:
+                    conn.sock.settimeout(timeout)
+            self.nreused += 1
+            return conn, True
+
+    def put_conn(self, conn):
+        """
+        Returns a connection (with its response fully read) to the pool
+        """
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append((time.time(), conn))
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            for t, conn in self.idle:
+                conn.close()
+            self.idle = []
+
+    def request(self, path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, headers=None):
+        """
+        GETs `path` from this host, returning ``(conn, response)``.
+
+        If a reused connection turns out to have been dropped by the server,
+        the request is retried once on a fresh connection.  Timeouts are never
+        retried.
+        """
+        hdrs = {'Connection': 'keep-alive'}
+        if headers:
+            hdrs.update(headers)
+
+        while True:
+            conn, reused = self.get_conn(timeout)
+            try:
+                conn.request('GET', path, headers=hdrs)
+                resp = conn.getresponse()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (httplib.BadStatusLine, httplib.CannotSendRequest,
+                    httplib.ResponseNotReady, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            return conn, resp
+
+
+class PooledResponse(object):
+    """
+    A file-like wrapper around an `httplib.HTTPResponse` that gives its
+    connection back to the pool once the body has been read.
+    """
+    def __init__(self, pool, conn, resp, url):
+        self.pool = pool
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.code = resp.status
+
+    def read(self, amt=None):
+        data = self.resp.read() if amt is None else self.resp.read(amt)
+        if self.resp.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self.conn is not None:
+            if self.resp.will_close:
+                self.conn.close()
+            else:
+                self.pool.put_conn(self.conn)
+            self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            if self.resp.isclosed():
+                self._release()
+            else:  # unread body - the connection can't be reused
+                self.resp.close()
+                self.conn.close()
+                self.conn = None
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.resp.msg
+
+
+def configure_pools(maxsize=None, idletimeout=None):
+    """
+    Sets the size and idle timeout of the pools `urlopen` uses.  Existing
+    pools are closed so they pick up the new settings.
+    """
+    global poolsize, poolidletimeout
+
+    if maxsize is not None:
+        poolsize = maxsize
+    if idletimeout is not None:
+        poolidletimeout = idletimeout
+    close_pools()
+
+
+def close_pools():
+    with _poolslock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def get_pool(scheme, host):
+    """
+    Returns the (shared) `HTTPConnectionPool` for the given scheme and host
+    """
+    global _poolspid
+
+    with _poolslock:
+        if _poolspid != os.getpid():
+            # forked - the parent's sockets are not ours to use
+            _pools.clear()
+            _poolspid = os.getpid()
+
+        pool = _pools.get((scheme, host))
+        if pool is None:
+            pool = HTTPConnectionPool(scheme, host, poolsize, poolidletimeout)
+            _pools[(scheme, host)] = pool
+        return pool
+
+
+def urlopen(url, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    """
+    A stand-in for `urllib2.urlopen` (for GETs) that uses the pooled
+    connections.  Follows redirects, and raises `urllib2.HTTPError` for error
+    status codes just like `urllib2.urlopen`.
+    """
+    url = url.strip()
+    for i in range(maxredirects + 1):
+        scheme, host, path, query, fragment = urlsplit(url)
+        pool = get_pool(scheme, host)
+        reqpath = (path or '/') + ('?' + query if query else '')
+
+        conn, resp = pool.request(reqpath, timeout)
+        res = PooledResponse(pool, conn, resp, url)
+
+        location = resp.getheader('location')
+        if resp.status in (301, 302, 303, 307) and location:
+            res.read()
+            res.close()
+            url = urljoin(url, location.strip())
+            continue
+
+        if resp.status >= 400:
+            body = res.read()
+            res.close()
+            raise HTTPError(url, resp.status, resp.reason, resp.msg, StringIO(body))
+
+        return res
+
+    raise HTTPError(url, resp.status, 'Too many redirects', resp.msg, None)
+
+
+class ResponseCache(object):
+    """
+    An on-disk cache of response bodies, keyed on a hash of the request URL
+    with the scheme and host removed, so the same query to any of the ADS
+    mirrors finds the same entry.
+
+    Entries older than `ttl` sec (if not None) are treated as missing.  If
+    `maxbytes` is not None, the oldest entries are removed
+    whenever the cache grows past that size.
+
+    The hit/miss counts are for this process only - a forked worker's counts
+    can be added back in the parent with `counts` and `add_counts`.
+    """
+    def __init__(self, cachedir, ttl=None, maxbytes=None):
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.nbytes = sum([sz for pth, mtime, sz in self._entries()])
+
+    def __repr__(self):
+        return '<ResponseCache: "{0}" ({1} bytes)>'.format(self.cachedir, self.nbytes)
+
+    @staticmethod
+    def normalize_url(url):
+        """
+        The part of `url` the cache keys on: the path and the query, with the
+        query parameters sorted.
+        """
+        from urllib import urlencode
+        from urlparse import parse_qsl
+
+        scheme, host, path, query, fragment = urlsplit(url.strip())
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+        return (path or '/') + '?' + query
+
+    def key(self, url):
+        import hashlib
+
+        return hashlib.sha1(self.normalize_url(url)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, key[:2], key)
+
+    def _entries(self):
+        """
+        Yields ``(path, mtime, size)`` for every entry
+        """
+        for subdir in os.listdir(self.cachedir):
+            subpath = os.path.join(self.cachedir, subdir)
+            if not os.path.isdir(subpath):
+                continue
+            for fn in os.listdir(subpath):
+                pth = os.path.join(subpath, fn)
+                try:
+                    st = os.stat(pth)
+                except OSError:  # removed by someone else
+                    continue
+                yield pth, st.st_mtime, st.st_size
+
+    def has(self, url):
+        """
+        True if there is an unexpired entry for `url`.  Doesn't count as a hit
+        or miss.
+        """
+        try:
+            st = os.stat(self._path(self.key(url)))
+        except OSError:
+            return False
+        return self.ttl is None or (time.time() - st.st_mtime) <= self.ttl
+
+    def get(self, url):
+        """
+        Returns the cached body for `url`, or None if there isn't one
+        """
+        pth = self._path(self.key(url))
+        try:
+            st = os.stat(pth)
+        except OSError:
+            self.misses += 1
+            return None
+
+        if self.ttl is not None and (time.time() - st.st_mtime) > self.ttl:
+            self._remove(pth, st.st_size)
+            self.expired += 1
+            self.misses += 1
+            return None
+
+        try:
+            with open(pth, 'rb') as f:
+                body = f.read()
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return body
+
+    def put(self, url, body):
+        pth = self._path(self.key(url))
+        dirpth = os.path.dirname(pth)
+        if not os.path.isdir(dirpth):
+            try:
+                os.makedirs(dirpth)
+            except OSError:  # another process may have just made it
+                pass
+
+        try:
+            oldsize = os.stat(pth).st_size
+        except OSError:
+            oldsize = 0
+
+        tmppth = '{0}.{1}.tmp'.format(pth, os.getpid())
+        with open(tmppth, 'wb') as f:
+            f.write(body)
+        os.rename(tmppth, pth)
+        self.nbytes += len(body) - oldsize
+
+        if self.maxbytes is not None and self.nbytes > self.maxbytes:
+            self.evict()
+
+    def _remove(self, pth, size):
+        try:
+            os.remove(pth)
+            self.nbytes -= size
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Removes the oldest entries until the cache is no bigger than `maxbytes`
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.nbytes = sum([e[2] for e in entries])
+        for pth, mtime, sz in entries:
+            if self.nbytes <= self.maxbytes:
+                break
+            self._remove(pth, sz)
+            self.evictions += 1
+
+    def clear(self):
+        for pth, mtime, sz in list(self._entries()):
+            self._remove(pth, sz)
+
+    def counts(self):
+        """
+        The hit, miss, expired and eviction counts, as a dictionary
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions}
+
+    def add_counts(self, counts):
+        """
+        Adds `counts` (as from `counts`) to this cache's counts
+        """
+        for nm, n in counts.iteritems():
+            setattr(self, nm, getattr(self, nm) + n)
+
+    def stats(self):
+        # other processes may be writing to the cache too, so the size is
+        # counted afresh
+        self.nbytes = sum([sz for pth, mtime, sz in self._entries()])
+        nreq = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hitrate': self.hits / nreq if nreq > 0 else float('nan'),
+                'nbytes': self.nbytes}
+
+
+_cache = None
+
+
+def configure_cache(cachedir, ttl=None, maxbytes=None):
+    """
+    Turns on the response cache `fetch` uses (see `ResponseCache`), or turns
+    it off if `cachedir` is None.  Returns the cache.
+    """
+    global _cache
+
+    _cache = None if cachedir is None else ResponseCache(cachedir, ttl, maxbytes)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+class RateLimiter(object):
+    """
+    Makes callers of `wait` start at least `interval` sec apart.  Safe to share
+    between threads.
+    """
+    def __init__(self, interval, lasttime=-float('inf')):
+        self.interval = interval
+        self.lasttime = lasttime
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed, and then claims it.
+        """
+        with self.lock:
+            dtime = time.time() - self.lasttime
+            if dtime < self.interval:
+                time.sleep(self.interval - dtime)
+            self.lasttime = time.time()
+
+    def delay(self, secs):
+        """
+        Makes the next call wait `secs` from now instead of `interval`.
+        """
+        with self.lock:
+            self.lasttime = time.time() + secs - self.interval
+
+
+def fetch(url, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, usecache=True):
+    """
+    Returns the body from GETting `url`, from the response cache if it has
+    been configured (with `configure_cache`) and has the url.  Only
+    successful responses are cached.
+    """
+    from contextlib import closing
+
+    cache = _cache if usecache else None
+    if cache is not None:
+        body = cache.get(url)
+        if body is not None:
+            return body
+
+    with closing(urlopen(url, timeout)) as w:
+        body = w.read()
+
+    if cache is not None:
+        cache.put(url, body)
+    return body
+
+
+def iter_fetch(url, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, chunksize=16384, usecache=True):
+    """
+    Like `fetch`, but yields the body in pieces of up to `chunksize` bytes as
+    they arrive, so it can be processed while the rest is still coming.
+
+    If the response cache is configured, a cached body is yielded from there,
+    and a fresh one is cached once it has all arrived (which means holding on
+    to the whole body, as `fetch` does).
+    """
+    from contextlib import closing
+
+    cache = _cache if usecache else None
+    if cache is not None:
+        body = cache.get(url)
+        if body is not None:
+            for i in range(0, len(body), chunksize):
+                yield body[i:i + chunksize]
+            return
+
+    chunks = [] if cache is not None else None
+    with closing(urlopen(url, timeout)) as w:
+        while True:
+            chunk = w.read(chunksize)
+            if not chunk:
+                break
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+
+    if cache is not None:
+        cache.put(url, ''.join(chunks))